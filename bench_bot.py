@@ -0,0 +1,374 @@
+"""
+Нагрузочный прогон бота без сети.
+
+Синтетические партнёры проходят весь путь — /start, ФИО, город, меню
+обучения, материал, тест — через настоящие обработчики Application.
+Bot API подменяется локальной заглушкой, Google Таблицы — листами в памяти;
+у обеих настраиваются задержка и доля ответов 429.
+
+Пример:
+    python bench_bot.py --users 2000 --concurrency 500 --sheets-latency 0.3 --sheets-429 0.1
+"""
+import os
+import sys
+import json
+import time
+import random
+import logging
+import asyncio
+import argparse
+import tempfile
+import threading
+from collections import defaultdict
+
+# Бот читает настройки при импорте: токен, файлы SQLite и Google Таблицы
+BENCH_DIR = tempfile.mkdtemp(prefix="bot-bench-")
+os.environ.setdefault("BOT_TOKEN", "123456:BENCH")
+os.environ.setdefault("DB_PATH", os.path.join(BENCH_DIR, "bot_data.db"))
+os.environ.setdefault("SESSION_DB_PATH", os.path.join(BENCH_DIR, "bot_sessions.db"))
+os.environ.setdefault("BROADCAST_DB_PATH", os.path.join(BENCH_DIR, "bot_broadcasts.db"))
+os.environ.setdefault("SHEETS_FLUSH_INTERVAL", "0.5")
+# Синтетические партнёры нажимают кнопки без пауз: по умолчанию лимиты
+# Telegram сняты, чтобы мерить обработчики. Задайте TELEGRAM_* явно,
+# чтобы прогнать бота с боевыми лимитами.
+os.environ.setdefault("TELEGRAM_GLOBAL_RATE", "100000")
+os.environ.setdefault("TELEGRAM_CHAT_RATE", "100000")
+os.environ.setdefault("TELEGRAM_CHAT_BURST", "100000")
+os.environ.pop("GOOGLE_SERVICE_ACCOUNT_JSON", None)
+
+import gspread
+from telegram import Update
+from telegram.request import BaseRequest
+
+import my_company_bot as bot
+
+# Журнал бота на каждую запись заглушил бы отчёт
+logging.getLogger().setLevel(logging.WARNING)
+
+# ==============================
+# 🤖 FAKE BOT API
+# ==============================
+class FakeBotRequest(BaseRequest):
+    """Bot API в памяти: отвечает на вызовы бота и запоминает последнее сообщение в каждом чате"""
+
+    def __init__(self, latency: float = 0.0, rate_limit_ratio: float = 0.0):
+        self.latency = latency
+        self.rate_limit_ratio = rate_limit_ratio
+        self.calls = defaultdict(int)
+        self.rate_limited = 0
+        self._message_ids = defaultdict(int)
+        # chat_id -> {"message_id", "text", "reply_markup"}
+        self.last_message = {}
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        endpoint = url.rsplit("/", 1)[-1]
+        self.calls[endpoint] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if endpoint not in ("getMe", "answerCallbackQuery") and random.random() < self.rate_limit_ratio:
+            self.rate_limited += 1
+            return 429, json.dumps({
+                "ok": False,
+                "error_code": 429,
+                "description": "Too Many Requests: retry after 1",
+                "parameters": {"retry_after": 1},
+            }).encode()
+
+        params = request_data.parameters if request_data else {}
+        return 200, json.dumps({"ok": True, "result": self._result(endpoint, params)}).encode()
+
+    def _result(self, endpoint: str, params: dict):
+        if endpoint == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        if endpoint in ("sendMessage", "editMessageText"):
+            chat_id = int(params["chat_id"])
+            if endpoint == "sendMessage" or chat_id not in self.last_message:
+                self._message_ids[chat_id] += 1
+            markup = params.get("reply_markup")
+            if isinstance(markup, str):
+                markup = json.loads(markup)
+            message = {
+                "message_id": self._message_ids[chat_id],
+                "text": params.get("text", ""),
+                "reply_markup": markup,
+            }
+            self.last_message[chat_id] = message
+            return {
+                "message_id": message["message_id"],
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "from": {"id": 1, "is_bot": True, "first_name": "Bench"},
+                "text": message["text"],
+            }
+        return True
+
+# ==============================
+# 📊 FAKE GOOGLE SHEETS
+# ==============================
+class FakeResponse:
+    """Минимальный ответ для gspread.exceptions.APIError"""
+
+    def __init__(self, status_code: int):
+        self.status_code = status_code
+        self.text = "quota"
+
+    def json(self):
+        return {"error": {"code": self.status_code, "message": "Quota exceeded", "status": "RESOURCE_EXHAUSTED"}}
+
+class FakeWorksheet:
+    """Лист gspread в памяти с задержкой и отказами 429"""
+
+    def __init__(self, title: str, headers: list, latency: float = 0.0, rate_limit_ratio: float = 0.0):
+        self.title = title
+        self.rows = [list(headers)]
+        self.latency = latency
+        self.rate_limit_ratio = rate_limit_ratio
+        self.calls = defaultdict(int)
+        self.rate_limited = 0
+        self._lock = threading.Lock()
+
+    def _call(self, name: str):
+        # gspread синхронный: бот вызывает его из пула потоков, поэтому time.sleep
+        self.calls[name] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if random.random() < self.rate_limit_ratio:
+            self.rate_limited += 1
+            raise gspread.exceptions.APIError(FakeResponse(429))
+
+    def append_row(self, row, **kwargs):
+        self._call("append_row")
+        with self._lock:
+            self.rows.append([str(value) for value in row])
+
+    def append_rows(self, rows, **kwargs):
+        self._call("append_rows")
+        with self._lock:
+            self.rows.extend([str(value) for value in row] for row in rows)
+
+    def get_all_values(self):
+        self._call("get_all_values")
+        with self._lock:
+            return [list(row) for row in self.rows]
+
+    def col_values(self, col: int):
+        self._call("col_values")
+        with self._lock:
+            return [row[col - 1] if len(row) >= col else "" for row in self.rows]
+
+    def row_values(self, row: int):
+        self._call("row_values")
+        with self._lock:
+            return list(self.rows[row - 1])
+
+    def find(self, query: str, in_column: int = None):
+        self._call("find")
+        with self._lock:
+            for row_index, row in enumerate(self.rows, start=1):
+                for col_index, value in enumerate(row, start=1):
+                    if value == query and in_column in (None, col_index):
+                        return gspread.cell.Cell(row_index, col_index, value)
+        return None
+
+# ==============================
+# 👥 SYNTHETIC PARTNERS
+# ==============================
+class Stats:
+    """Длительности обработки обновлений по обработчикам"""
+
+    def __init__(self):
+        self.durations = defaultdict(list)
+        self.errors = 0
+        # Партнёры, которым бот не прислал нужного сообщения (например, после 429)
+        self.stuck = 0
+
+    def record(self, handler: str, seconds: float):
+        self.durations[handler].append(seconds)
+
+    @staticmethod
+    def percentile(values: list, q: float) -> float:
+        ordered = sorted(values)
+        index = min(len(ordered) - 1, max(0, int(round(q * (len(ordered) - 1)))))
+        return ordered[index]
+
+    def report(self, wall_time: float) -> str:
+        total = sum(len(values) for values in self.durations.values())
+        lines = [
+            f"Обновлений: {total} за {wall_time:.2f} с — {total / wall_time:.1f} upd/s",
+            f"{'handler':<14}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}",
+        ]
+        for handler, values in sorted(self.durations.items()):
+            lines.append(
+                f"{handler:<14}{len(values):>8}"
+                f"{self.percentile(values, 0.50) * 1000:>10.1f}"
+                f"{self.percentile(values, 0.95) * 1000:>10.1f}"
+                f"{self.percentile(values, 0.99) * 1000:>10.1f}"
+                f"{max(values) * 1000:>10.1f}"
+            )
+        return "\n".join(lines)
+
+class Partner:
+    """Один синтетический партнёр ПВЗ"""
+
+    _update_ids = iter(range(1, 10 ** 9))
+
+    def __init__(self, user_id: int, application, api: FakeBotRequest, stats: Stats):
+        self.user_id = user_id
+        self.application = application
+        self.api = api
+        self.stats = stats
+        self.user = {"id": user_id, "is_bot": False, "first_name": f"Partner{user_id}", "username": f"partner{user_id}"}
+
+    def _message(self, text: str) -> dict:
+        message = {
+            "message_id": random.randint(1, 10 ** 6),
+            "date": int(time.time()),
+            "chat": {"id": self.user_id, "type": "private"},
+            "from": self.user,
+            "text": text,
+        }
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return message
+
+    async def _process(self, handler: str, data: dict):
+        data["update_id"] = next(self._update_ids)
+        update = Update.de_json(data, self.application.bot)
+        started = time.perf_counter()
+        try:
+            # Тот же путь, что у обновлений из очереди: через update_processor
+            await self.application.update_processor.process_update(
+                update, self.application.process_update(update)
+            )
+        except Exception:
+            self.stats.errors += 1
+        self.stats.record(handler, time.perf_counter() - started)
+
+    async def send_text(self, text: str):
+        handler = "start" if text == "/start" else "handle_text"
+        await self._process(handler, {"message": self._message(text)})
+
+    def buttons(self) -> list:
+        """Кнопки последнего сообщения бота в чате"""
+        message = self.api.last_message.get(self.user_id)
+        if not message or not message["reply_markup"]:
+            return []
+        return [button for row in message["reply_markup"]["inline_keyboard"] for button in row]
+
+    async def press(self, button: dict):
+        message = self.api.last_message[self.user_id]
+        await self._process("button", {
+            "callback_query": {
+                "id": str(next(self._update_ids)),
+                "from": self.user,
+                "chat_instance": str(self.user_id),
+                "data": button["callback_data"],
+                "message": {
+                    "message_id": message["message_id"],
+                    "date": int(time.time()),
+                    "chat": {"id": self.user_id, "type": "private"},
+                    "from": {"id": 1, "is_bot": True, "first_name": "Bench"},
+                    "text": message["text"],
+                },
+            }
+        })
+
+    def in_question(self) -> bool:
+        message = self.api.last_message.get(self.user_id)
+        return bool(message) and message["text"].startswith("📝")
+
+    async def run(self):
+        """Регистрация → меню обучения → материал → тест до результата"""
+        await self.send_text("/start")
+        await self.send_text(f"Партнёр {self.user_id}")
+        await self.send_text(random.choice(["Москва", "Казань", "Самара", "Пермь"]))
+
+        steps = (
+            lambda buttons: buttons[0],                 # 📚 Обучение
+            lambda buttons: random.choice(buttons[:-1]),  # материал (без «Назад»)
+            lambda buttons: buttons[0],                 # ✅ Пройти тест
+        )
+        for choose in steps:
+            buttons = self.buttons()
+            if not buttons:
+                self.stats.stuck += 1
+                return
+            await self.press(choose(buttons))
+
+        for _ in range(100):
+            if not self.in_question():
+                break
+            await self.press(random.choice(self.buttons()))       # вариант ответа
+
+# ==============================
+# 🚀 RUN
+# ==============================
+async def run_bench(args) -> str:
+    random.seed(args.seed)
+    api = FakeBotRequest(latency=args.bot_latency, rate_limit_ratio=args.bot_429)
+    bot.USERS_SHEET = FakeWorksheet("Пользователи", bot.USER_COLUMNS, args.sheets_latency, args.sheets_429)
+    bot.TESTS_SHEET = FakeWorksheet("Тесты", bot.RESULT_COLUMNS, args.sheets_latency, args.sheets_429)
+    bot.load_registered_users()
+
+    application = bot.build_application(request=api)
+    await application.initialize()
+    await bot.post_init(application)
+    await application.start()
+
+    stats = Stats()
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def run_partner(user_id: int):
+        async with semaphore:
+            await Partner(user_id, application, api, stats).run()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(run_partner(10 ** 6 + i) for i in range(args.users)))
+    wall_time = time.perf_counter() - started
+
+    flush_started = time.perf_counter()
+    await application.stop()
+    await bot.post_shutdown(application)
+    await application.shutdown()
+    flush_time = time.perf_counter() - flush_started
+
+    lines = [stats.report(wall_time), ""]
+    lines.append(f"Ошибок в обработке: {stats.errors}, в error_handler: {dict(bot.BOT_ERRORS.values)}")
+    lines.append(f"Партнёров без ответа бота: {stats.stuck}")
+    lines.append(f"Bot API: {dict(api.calls)}, 429: {api.rate_limited}")
+    for sheet in (bot.USERS_SHEET, bot.TESTS_SHEET):
+        lines.append(
+            f"Лист '{sheet.title}': строк {len(sheet.rows) - 1}, вызовы {dict(sheet.calls)}, 429: {sheet.rate_limited}"
+        )
+    lines.append(f"Остановка с дозаписью в таблицы: {flush_time:.2f} с")
+    return "\n".join(lines)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон бота обучения ПВЗ")
+    parser.add_argument("--users", type=int, default=500, help="число синтетических партнёров")
+    parser.add_argument("--concurrency", type=int, default=100, help="партнёров одновременно")
+    parser.add_argument("--bot-latency", type=float, default=0.02, help="задержка Bot API, с")
+    parser.add_argument("--bot-429", type=float, default=0.0, help="доля ответов 429 от Bot API")
+    parser.add_argument("--sheets-latency", type=float, default=0.2, help="задержка Google Таблиц, с")
+    parser.add_argument("--sheets-429", type=float, default=0.0, help="доля ответов 429 от Google Таблиц")
+    parser.add_argument("--seed", type=int, default=1)
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    print(asyncio.run(run_bench(args)))
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,36 +1,34 @@
 import os
+import sys
 import logging
 import threading
 import asyncio
-from flask import Flask
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes, MessageHandler, filters
-import gspread
-from google.oauth2.service_account import Credentials
-import json
-from datetime import datetime
-
-# ==============================
-# 🔌 FLASK SERVER FOR RENDER HEALTH
-# ==============================
-app = Flask(__name__)
-
-@app.route('/')
-def home():
-    return "OK", 200
+import time
 
-@app.route('/health')
-def health():
-    return "Bot is alive", 200
+# Отсчёт времени запуска — до тяжёлых импортов
+STARTUP_STARTED = time.perf_counter()
 
-def run_flask():
-    port = int(os.environ.get('PORT', 10000))
-    app.run(host='0.0.0.0', port=port)
-
-print("🚀 Запускаем Flask-сервер для здоровья...")
-flask_thread = threading.Thread(target=run_flask)
-flask_thread.daemon = True
-flask_thread.start()
+import functools
+import random
+import signal
+import inspect
+import secrets
+import zlib
+import heapq
+import itertools
+import sqlite3
+import csv
+import io
+from collections import OrderedDict, defaultdict, namedtuple
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from aiohttp import web
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
+from telegram.request import BaseRequest
+from telegram.ext import Application, BaseRateLimiter, BaseUpdateProcessor, CommandHandler, CallbackQueryHandler, ContextTypes, MessageHandler, filters
+import json
+from datetime import datetime, timedelta
 
 # ==============================
 # 🎛️ LOGGING & CONFIG
@@ -41,143 +39,1001 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Проверяется в main(): модуль можно импортировать без токена
 TOKEN = os.getenv("BOT_TOKEN")
-if not TOKEN:
-    logger.error("❌ BOT_TOKEN не задан!")
-    exit(1)
 
 ADMIN_ID = 397090905
 
+# ==============================
+# 📈 METRICS
+# ==============================
+# Метрики в текстовом формате Prometheus, отдаются на /metrics рядом с /health
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRICS = []
+
+def format_labels(label_names: tuple, label_values: tuple) -> str:
+    if not label_names:
+        return ""
+    pairs = (f'{name}="{str(value)}"' for name, value in zip(label_names, label_values))
+    return "{" + ",".join(pairs) + "}"
+
+class Counter:
+    """Счётчик, который только растёт"""
+
+    kind = "counter"
+
+    def __init__(self, name: str, description: str, labels: tuple = ()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.values = {}
+        METRICS.append(self)
+
+    def inc(self, *label_values, amount: float = 1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def samples(self):
+        for label_values, value in self.values.items():
+            yield f"{self.name}{format_labels(self.labels, label_values)} {value}"
+
+class Gauge:
+    """Текущее значение: задаётся через set() или вычисляется функцией при сборе"""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, description: str, labels: tuple = (), collect=None):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        # collect() возвращает число или {значения меток: число}
+        self.collect = collect
+        self.values = {}
+        METRICS.append(self)
+
+    def set(self, value: float, *label_values):
+        self.values[label_values] = value
+
+    def samples(self):
+        values = self.values
+        if self.collect:
+            collected = self.collect()
+            values = collected if isinstance(collected, dict) else {(): collected}
+        for label_values, value in values.items():
+            yield f"{self.name}{format_labels(self.labels, label_values)} {value}"
+
+class Histogram:
+    """Распределение длительностей по корзинам"""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, description: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = buckets
+        # {значения меток: [счётчики корзин..., сумма, количество]}
+        self.values = {}
+        METRICS.append(self)
+
+    def observe(self, value: float, *label_values):
+        state = self.values.get(label_values)
+        if state is None:
+            state = self.values[label_values] = [0] * (len(self.buckets) + 2)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                state[i] += 1
+        state[-2] += value
+        state[-1] += 1
+
+    def samples(self):
+        bucket_labels = self.labels + ("le",)
+        for label_values, state in self.values.items():
+            for bound, count in zip(self.buckets, state):
+                yield f"{self.name}_bucket{format_labels(bucket_labels, label_values + (bound,))} {count}"
+            yield f"{self.name}_bucket{format_labels(bucket_labels, label_values + ('+Inf',))} {state[-1]}"
+            yield f"{self.name}_sum{format_labels(self.labels, label_values)} {state[-2]}"
+            yield f"{self.name}_count{format_labels(self.labels, label_values)} {state[-1]}"
+
+def render_metrics() -> str:
+    """Все метрики в текстовом формате Prometheus"""
+    lines = []
+    for metric in METRICS:
+        lines.append(f"# HELP {metric.name} {metric.description}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.samples())
+    return "\n".join(lines) + "\n"
+
+HANDLER_LATENCY = Histogram("bot_handler_duration_seconds", "Время работы обработчика", ("handler",))
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Исключения в обработчиках", ("handler",))
+BOT_ERRORS = Counter("bot_errors_total", "Ошибки, дошедшие до error_handler", ("type",))
+SHEETS_LATENCY = Histogram("bot_sheets_call_duration_seconds", "Время вызова Google Таблиц", ("operation",))
+SHEETS_CALLS = Counter("bot_sheets_calls_total", "Вызовы Google Таблиц", ("operation", "status"))
+
+def timed(handler_name: str):
+    """Декоратор: время и ошибки асинхронного обработчика"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            except Exception:
+                HANDLER_ERRORS.inc(handler_name)
+                raise
+            finally:
+                HANDLER_LATENCY.observe(time.perf_counter() - started, handler_name)
+        return wrapper
+    return decorator
+
 # ==============================
 # 📊 GOOGLE SHEETS INTEGRATION
 # ==============================
+USER_COLUMNS = ["user_id", "username", "fio", "city", "register_date", "last_activity"]
+RESULT_COLUMNS = ["user_id", "fio", "test_name", "score", "max_score", "pass_date", "answers"]
+
+class SheetsNotConfigured(Exception):
+    """Подключение к Google Таблицам не настроено — повторять бесполезно"""
+
 def init_google_sheets():
-    """Инициализация Google Таблиц"""
+    """Подключается к Google Таблицам и возвращает (лист пользователей, лист тестов)
+
+    Выполняется в пуле потоков из connect_google_sheets(); при сбое бросает
+    исключение, а без настроек — SheetsNotConfigured.
+    """
+    # gspread и google-auth импортируются долго — только когда нужны
+    import gspread
+    from google.oauth2.service_account import Credentials
+
+    scope = [
+        "https://spreadsheets.google.com/feeds",
+        "https://www.googleapis.com/auth/drive"
+    ]
+
+    json_key = os.getenv("GOOGLE_SERVICE_ACCOUNT_JSON")
+    if not json_key:
+        raise SheetsNotConfigured("GOOGLE_SERVICE_ACCOUNT_JSON не задан")
+
     try:
-        scope = [
-            "https://spreadsheets.google.com/feeds",
-            "https://www.googleapis.com/auth/drive"
-        ]
-        
-        json_key = os.getenv("GOOGLE_SERVICE_ACCOUNT_JSON")
-        if not json_key:
-            logger.error("❌ GOOGLE_SERVICE_ACCOUNT_JSON не задан!")
-            return None, None
-        
-        try:
-            credentials_dict = json.loads(json_key)
-        except json.JSONDecodeError as e:
-            logger.error(f"❌ Ошибка парсинга JSON: {e}")
-            return None, None
-        
-        credentials = Credentials.from_service_account_info(credentials_dict, scopes=scope)
-        client = gspread.authorize(credentials)
-        
-        sheet_url = os.getenv("GOOGLE_SHEET_URL")
-        if not sheet_url:
-            logger.error("❌ GOOGLE_SHEET_URL не задан!")
-            return None, None
-        
-        # Открываем таблицу
-        spreadsheet = client.open_by_url(sheet_url)
-        logger.info(f"✅ Таблица открыта: {spreadsheet.title}")
-        
-        # Получаем или создаем листы
-        users_sheet = get_or_create_worksheet(spreadsheet, "Пользователи", 
-                                            ["user_id", "username", "fio", "city", "register_date", "last_activity"])
-        
-        tests_sheet = get_or_create_worksheet(spreadsheet, "Тесты",
-                                            ["user_id", "fio", "test_name", "score", "max_score", "pass_date", "answers"])
-        
-        if users_sheet and tests_sheet:
-            logger.info("✅ Все листы готовы к работе!")
-            return users_sheet, tests_sheet
-        else:
-            logger.error("❌ Не удалось инициализировать листы")
-            return None, None
-        
-    except Exception as e:
-        logger.error(f"❌ Критическая ошибка инициализации Google Таблиц: {e}")
-        return None, None
+        credentials_dict = json.loads(json_key)
+    except json.JSONDecodeError as e:
+        raise SheetsNotConfigured(f"ошибка парсинга GOOGLE_SERVICE_ACCOUNT_JSON: {e}")
+
+    sheet_url = os.getenv("GOOGLE_SHEET_URL")
+    if not sheet_url:
+        raise SheetsNotConfigured("GOOGLE_SHEET_URL не задан")
+
+    credentials = Credentials.from_service_account_info(credentials_dict, scopes=scope)
+    client = gspread.authorize(credentials)
+
+    # Открываем таблицу
+    spreadsheet = client.open_by_url(sheet_url)
+    logger.info(f"✅ Таблица открыта: {spreadsheet.title}")
+
+    # Получаем или создаем листы
+    users_sheet = get_or_create_worksheet(spreadsheet, "Пользователи", USER_COLUMNS)
+    tests_sheet = get_or_create_worksheet(spreadsheet, "Тесты", RESULT_COLUMNS)
+    logger.info("✅ Все листы готовы к работе!")
+    return users_sheet, tests_sheet
 
 def get_or_create_worksheet(spreadsheet, sheet_name, headers):
     """Получает или создает лист с заголовками"""
+    import gspread
+
     try:
-        try:
-            worksheet = spreadsheet.worksheet(sheet_name)
-            logger.info(f"✅ Лист '{sheet_name}' найден")
-            
-            # Проверяем есть ли заголовки
-            existing_headers = worksheet.row_values(1)
-            if not existing_headers:
-                worksheet.append_row(headers)
-                logger.info(f"✅ Добавлены заголовки в лист '{sheet_name}'")
-                
-        except gspread.WorksheetNotFound:
-            logger.info(f"📄 Создаем лист '{sheet_name}'")
-            worksheet = spreadsheet.add_worksheet(title=sheet_name, rows="1000", cols=str(len(headers)))
+        worksheet = spreadsheet.worksheet(sheet_name)
+        logger.info(f"✅ Лист '{sheet_name}' найден")
+
+        # Проверяем есть ли заголовки
+        existing_headers = worksheet.row_values(1)
+        if not existing_headers:
             worksheet.append_row(headers)
-            logger.info(f"✅ Лист '{sheet_name}' создан с заголовками")
-        
-        return worksheet
-        
+            logger.info(f"✅ Добавлены заголовки в лист '{sheet_name}'")
+
+    except gspread.WorksheetNotFound:
+        logger.info(f"📄 Создаем лист '{sheet_name}'")
+        worksheet = spreadsheet.add_worksheet(title=sheet_name, rows="1000", cols=str(len(headers)))
+        worksheet.append_row(headers)
+        logger.info(f"✅ Лист '{sheet_name}' создан с заголовками")
+
+    return worksheet
+
+def sheets_error_status(error: Exception):
+    """HTTP-статус ошибки Google API или None для прочих ошибок"""
+    from gspread.exceptions import APIError
+
+    return error.response.status_code if isinstance(error, APIError) else None
+
+# Листы появляются, когда connect_google_sheets() подключится в фоне
+USERS_SHEET = None
+TESTS_SHEET = None
+SHEETS_CONNECT_TIMEOUT = float(os.getenv("SHEETS_CONNECT_TIMEOUT", 60))
+SHEETS_RECONNECT_MAX = float(os.getenv("SHEETS_RECONNECT_MAX", 300))
+
+SHEETS_CONNECTED = Gauge(
+    "bot_sheets_connected", "Подключены ли Google Таблицы", collect=lambda: int(bool(USERS_SHEET and TESTS_SHEET))
+)
+
+async def connect_google_sheets():
+    """Подключается к Google Таблицам в фоне; при сбое повторяет с растущей паузой"""
+    global USERS_SHEET, TESTS_SHEET
+    loop = asyncio.get_running_loop()
+    delay = 1.0
+    while True:
+        started = time.perf_counter()
+        try:
+            users_sheet, tests_sheet = await asyncio.wait_for(
+                loop.run_in_executor(SHEETS_EXECUTOR, init_google_sheets), timeout=SHEETS_CONNECT_TIMEOUT
+            )
+        except SheetsNotConfigured as e:
+            logger.warning(f"⚠️ Google Таблицы не подключены: {e}")
+            return
+        except Exception as e:
+            logger.error(f"❌ Ошибка подключения к Google Таблицам: {e!r}, повтор через {delay:.0f} с")
+            await asyncio.sleep(delay + random.uniform(0, delay / 2))
+            delay = min(delay * 2, SHEETS_RECONNECT_MAX)
+            continue
+        break
+
+    USERS_SHEET, TESTS_SHEET = users_sheet, tests_sheet
+    logger.info(f"✅ Google Таблицы подключены за {time.perf_counter() - started:.2f} с")
+    # Накопленное за время без таблиц выгружаем сразу
+    for exporter in SHEETS_EXPORTERS:
+        exporter.wakeup()
+    if STORAGE.is_remote:
+        await loop.run_in_executor(SHEETS_EXECUTOR, load_registered_users)
+
+# ==============================
+# 👥 REGISTERED USERS INDEX
+# ==============================
+# Индекс зарегистрированных user_id в памяти: проверка регистрации
+# на каждом нажатии кнопки не должна ходить в Google API
+REGISTERED_USERS = set()
+REGISTERED_USERS_LOCK = threading.Lock()
+# user_id, зарегистрированные во время текущей перезагрузки индекса
+_REGISTERED_DURING_REFRESH = set()
+REGISTERED_USERS_REFRESH_INTERVAL = int(os.getenv("REGISTERED_USERS_REFRESH_INTERVAL", 300))
+
+def load_registered_users() -> bool:
+    """Загружает список зарегистрированных user_id из хранилища в индекс"""
+    global REGISTERED_USERS, _REGISTERED_DURING_REFRESH
+    with REGISTERED_USERS_LOCK:
+        _REGISTERED_DURING_REFRESH = set()
+
+    try:
+        user_ids = STORAGE.registered_user_ids()
     except Exception as e:
-        logger.error(f"❌ Ошибка работы с листом '{sheet_name}': {e}")
-        return None
+        logger.error(f"❌ Ошибка загрузки списка пользователей: {e}")
+        return False
+
+    # Пользователи, сохранённые пока шла загрузка, могли не попасть в выборку
+    with REGISTERED_USERS_LOCK:
+        REGISTERED_USERS = user_ids | _REGISTERED_DURING_REFRESH
+
+    logger.info(f"✅ Индекс пользователей загружен: {len(user_ids)} записей")
+    return True
+
+def mark_user_registered(user_id: int):
+    """Добавляет пользователя в индекс после успешной записи"""
+    with REGISTERED_USERS_LOCK:
+        REGISTERED_USERS.add(user_id)
+        _REGISTERED_DURING_REFRESH.add(user_id)
 
-# Инициализируем Google Таблицы
-USERS_SHEET, TESTS_SHEET = init_google_sheets()
+def refresh_registered_users_loop():
+    """Периодически перечитывает индекс (ручные правки таблицы, удаления)"""
+    while True:
+        time.sleep(REGISTERED_USERS_REFRESH_INTERVAL)
+        load_registered_users()
 
 # ==============================
 # 🧠 USER STATE & TESTS
 # ==============================
-USER_STATE = {}
-TESTS = {
-    "test_order": {
-        "title": "Тест: Приём заказа",
-        "questions": [
-            {
-                "question": "Что нужно сделать первым при приёме заказа?",
-                "options": [
-                    "Поприветствовать клиента по имени",
-                    "Сразу запросить оплату",
-                    "Уточнить адрес доставки",
-                    "Открыть CRM-систему"
-                ],
-                "correct": 0
-            },
-            {
-                "question": "Как правильно подтвердить заказ клиенту?",
-                "options": [
-                    "Отправить SMS или email с деталями",
-                    "Позвонить и устно подтвердить",
-                    "Ничего не делать — клиент сам разберётся",
-                    "Отправить сообщение в WhatsApp"
-                ],
-                "correct": 0
-            }
-        ]
-    },
-    "test_shipping": {
-        "title": "Тест: Отгрузка товара",
-        "questions": [
-            {
-                "question": "Что проверить перед отгрузкой?",
-                "options": [
-                    "Оплату в системе",
-                    "Цвет упаковки",
-                    "Погоду на улице",
-                    "Наличие кофе у сотрудника"
-                ],
-                "correct": 0
-            }
-        ]
-    }
+# Сессии пользователей: в памяти не больше SESSION_MAX_ENTRIES последних
+# (LRU), неактивные дольше SESSION_TTL секунд удаляются. Если задан
+# SESSION_DB_PATH, сессии пишутся на диск и переживают перезапуск бота —
+# в том числе посреди теста.
+SESSION_TTL = int(os.getenv("SESSION_TTL", 24 * 3600))
+SESSION_MAX_ENTRIES = int(os.getenv("SESSION_MAX_ENTRIES", 10000))
+SESSION_DB_PATH = os.getenv("SESSION_DB_PATH", "bot_sessions.db")
+SESSION_SWEEP_INTERVAL = int(os.getenv("SESSION_SWEEP_INTERVAL", 600))
+
+class Session:
+    """Состояние диалога с пользователем"""
+
+    __slots__ = ("state", "fio", "city", "username", "test", "screen", "touched")
+
+    def __init__(self, state=None, fio=None, city=None, username=None, test=None, screen=None, touched=None):
+        # Состояние диалога (см. CONVERSATION STATE MACHINE), None — свободный диалог
+        self.state = state
+        self.fio = fio
+        self.city = city
+        self.username = username
+        # Прогресс теста: {'key', 'current_question', 'score', 'answers', 'nonce'}
+        self.test = test
+        # Последний показанный экран теста: [message_id, отпечаток содержимого]
+        self.screen = screen
+        self.touched = touched or time.time()
+
+    def to_json(self) -> str:
+        return json.dumps({name: getattr(self, name) for name in self.__slots__}, ensure_ascii=False)
+
+    @classmethod
+    def from_json(cls, data: str) -> "Session":
+        return cls(**json.loads(data))
+
+# ==============================
+# 🔒 SHARED STATE
+# ==============================
+# Где живут сессии и межпроцессные замки. По умолчанию (SHARED_STATE не
+# задан) — локальный файл SESSION_DB_PATH с кэшем сессий в памяти, один
+# экземпляр бота. Для нескольких реплик за одним webhook:
+#   SHARED_STATE=sqlite — SESSION_DB_PATH на общем томе (реплики на одном хосте);
+#   SHARED_STATE=redis  — Redis-совместимый сервер по REDIS_URL (нужен пакет redis).
+# В общем режиме сессия всегда читается из хранилища, а обновления одного
+# пользователя сериализуются замком user:<id>, поэтому тест не «разъезжается»
+# между репликами. Пользователи, результаты и рассылки в любом общем режиме
+# лежат в SQLite на общем томе SHARED_DATA_DIR (DB_PATH, BROADCAST_DB_PATH),
+# иначе бот не запустится (см. shared_setup_errors).
+SHARED_STATE = os.getenv("SHARED_STATE", "")  # "" | sqlite | redis
+SHARED_DATA_DIR = os.getenv("SHARED_DATA_DIR")
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+REDIS_PREFIX = os.getenv("REDIS_PREFIX", "pvz-bot:")
+USER_LOCK_TTL = float(os.getenv("USER_LOCK_TTL", 60))
+REPLICA_ID = f"{os.getenv('HOSTNAME', 'local')}:{os.getpid()}:{secrets.token_hex(2)}"
+
+class StateStore(ABC):
+    """Хранилище сессий и замков с истечением"""
+
+    # Хранилище видят другие реплики: сессии нельзя брать из кэша
+    shared = False
+
+    @abstractmethod
+    def load_session(self, user_id: int):
+        """JSON сессии или None"""
+
+    @abstractmethod
+    def save_session(self, user_id: int, data: str, touched: float):
+        """Сохраняет JSON сессии"""
+
+    @abstractmethod
+    def delete_session(self, user_id: int):
+        """Удаляет сессию"""
+
+    @abstractmethod
+    def sweep_sessions(self, cutoff: float) -> int:
+        """Удаляет сессии, не тронутые с cutoff; возвращает их число"""
+
+    @abstractmethod
+    def try_lock(self, key: str, owner: str, ttl: float) -> bool:
+        """Берёт замок на ttl секунд; владелец может продлить свой замок"""
+
+    @abstractmethod
+    def unlock(self, key: str, owner: str):
+        """Отпускает замок, если он всё ещё принадлежит owner"""
+
+class SQLiteStateStore(StateStore):
+    """Сессии и замки в файле SQLite; на общем томе его делят реплики одного хоста"""
+
+    def __init__(self, path: str, shared: bool = False):
+        self.shared = shared
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        with self._conn:
+            self._conn.execute(
+                """CREATE TABLE IF NOT EXISTS sessions (
+                    user_id INTEGER PRIMARY KEY,
+                    data TEXT NOT NULL,
+                    touched REAL NOT NULL
+                )"""
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS sessions_touched ON sessions (touched)")
+            self._conn.execute(
+                """CREATE TABLE IF NOT EXISTS locks (
+                    key TEXT PRIMARY KEY,
+                    owner TEXT NOT NULL,
+                    expires REAL NOT NULL
+                )"""
+            )
+
+    def load_session(self, user_id):
+        row = self._conn.execute("SELECT data FROM sessions WHERE user_id = ?", (user_id,)).fetchone()
+        return row[0] if row else None
+
+    def save_session(self, user_id, data, touched):
+        with self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO sessions (user_id, data, touched) VALUES (?, ?, ?)", (user_id, data, touched)
+            )
+
+    def delete_session(self, user_id):
+        with self._conn:
+            self._conn.execute("DELETE FROM sessions WHERE user_id = ?", (user_id,))
+
+    def sweep_sessions(self, cutoff):
+        with self._conn:
+            return self._conn.execute("DELETE FROM sessions WHERE touched <= ?", (cutoff,)).rowcount
+
+    def try_lock(self, key, owner, ttl):
+        now = time.time()
+        with self._conn:
+            # Чужой замок перехватывается, только если он истёк
+            return self._conn.execute(
+                """INSERT INTO locks (key, owner, expires) VALUES (?, ?, ?)
+                   ON CONFLICT (key) DO UPDATE SET owner = excluded.owner, expires = excluded.expires
+                   WHERE locks.expires <= ? OR locks.owner = excluded.owner""",
+                (key, owner, now + ttl, now)
+            ).rowcount > 0
+
+    def unlock(self, key, owner):
+        with self._conn:
+            self._conn.execute("DELETE FROM locks WHERE key = ? AND owner = ?", (key, owner))
+
+class RedisStateStore(StateStore):
+    """Сессии и замки в Redis-совместимом сервере; сессии истекают сами по TTL"""
+
+    shared = True
+
+    # Проверка владельца и изменение замка одной атомарной операцией
+    _LOCK_SCRIPT = """
+        if redis.call('get', KEYS[1]) == ARGV[1] then
+            return redis.call('pexpire', KEYS[1], ARGV[2])
+        end
+        return redis.call('set', KEYS[1], ARGV[1], 'NX', 'PX', ARGV[2]) and 1 or 0
+    """
+    _UNLOCK_SCRIPT = """
+        if redis.call('get', KEYS[1]) == ARGV[1] then
+            return redis.call('del', KEYS[1])
+        end
+        return 0
+    """
+
+    def __init__(self, client, ttl: int, prefix: str = REDIS_PREFIX):
+        self._client = client
+        self.ttl = ttl
+        self.prefix = prefix
+        self._lock = client.register_script(self._LOCK_SCRIPT)
+        self._unlock = client.register_script(self._UNLOCK_SCRIPT)
+
+    def _session_key(self, user_id: int) -> str:
+        return f"{self.prefix}session:{user_id}"
+
+    def load_session(self, user_id):
+        data = self._client.get(self._session_key(user_id))
+        return data.decode() if isinstance(data, bytes) else data
+
+    def save_session(self, user_id, data, touched):
+        self._client.set(self._session_key(user_id), data, ex=self.ttl)
+
+    def delete_session(self, user_id):
+        self._client.delete(self._session_key(user_id))
+
+    def sweep_sessions(self, cutoff):
+        return 0
+
+    def try_lock(self, key, owner, ttl):
+        return bool(self._lock(keys=[self.prefix + key], args=[owner, int(ttl * 1000)]))
+
+    def unlock(self, key, owner):
+        self._unlock(keys=[self.prefix + key], args=[owner])
+
+def create_state_store():
+    """Создаёт хранилище сессий и замков по SHARED_STATE"""
+    if SHARED_STATE == "redis":
+        try:
+            import redis
+        except ImportError:
+            logger.error("❌ SHARED_STATE=redis требует пакет redis (pip install redis)")
+            exit(1)
+        logger.info(f"🔒 Общее состояние реплик: Redis ({REDIS_URL})")
+        return RedisStateStore(redis.Redis.from_url(REDIS_URL), SESSION_TTL)
+    if SHARED_STATE == "sqlite":
+        logger.info(f"🔒 Общее состояние реплик: SQLite ({SESSION_DB_PATH})")
+        return SQLiteStateStore(SESSION_DB_PATH, shared=True)
+    return SQLiteStateStore(SESSION_DB_PATH) if SESSION_DB_PATH else None
+
+STATE_STORE = create_state_store()
+
+def try_lease(key: str, ttl: float) -> bool:
+    """Берёт или продлевает замок этой реплики; без хранилища реплика одна"""
+    return STATE_STORE is None or STATE_STORE.try_lock(key, REPLICA_ID, ttl)
+
+def release_lease(key: str):
+    if STATE_STORE is not None:
+        STATE_STORE.unlock(key, REPLICA_ID)
+
+async def acquire_lease(key: str, ttl: float):
+    """Ждёт замок, опрашивая хранилище с нарастающей паузой"""
+    delay = 0.005
+    while not try_lease(key, ttl):
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 0.1)
+
+async def keep_lease(key: str, ttl: float):
+    """Продлевает взятый замок, пока задачу не отменят"""
+    while True:
+        await asyncio.sleep(ttl / 3)
+        if not try_lease(key, ttl):
+            logger.warning(f"⚠️ Замок {key} перехвачен другой репликой")
+            return
+
+class SessionStore:
+    """Ограниченное хранилище сессий с вытеснением по TTL и LRU"""
+
+    def __init__(self, store: StateStore = None, ttl: int = SESSION_TTL, max_entries: int = SESSION_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._sessions = OrderedDict()
+        self._store = store
+        # В общем режиме память — только место для изменяемой сессии, не кэш
+        self._cached = not (store and store.shared)
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def __contains__(self, user_id: int) -> bool:
+        return self.get(user_id) is not None
+
+    def get(self, user_id: int):
+        """Сессия пользователя или None; продлевает её жизнь"""
+        session = self._sessions.get(user_id) if self._cached else None
+        if session is None and self._store:
+            data = self._store.load_session(user_id)
+            if data:
+                session = Session.from_json(data)
+                self._remember(user_id, session)
+        if session is None:
+            return None
+        if time.time() - session.touched > self.ttl:
+            self.delete(user_id)
+            return None
+        session.touched = time.time()
+        self._sessions.move_to_end(user_id)
+        return session
+
+    def create(self, user_id: int, **fields) -> Session:
+        """Начинает новую сессию, заменяя прежнюю"""
+        session = Session(**fields)
+        self._remember(user_id, session)
+        self.save(user_id)
+        return session
+
+    def get_or_create(self, user_id: int) -> Session:
+        return self.get(user_id) or self.create(user_id)
+
+    def save(self, user_id: int):
+        """Сохраняет изменения сессии на диск"""
+        session = self._sessions.get(user_id)
+        if session is None or not self._store:
+            return
+        self._store.save_session(user_id, session.to_json(), session.touched)
+
+    def delete(self, user_id: int):
+        self._sessions.pop(user_id, None)
+        if self._store:
+            self._store.delete_session(user_id)
+
+    def _remember(self, user_id: int, session: Session):
+        self._sessions[user_id] = session
+        self._sessions.move_to_end(user_id)
+        # Из памяти вытесняются давно не активные; на диске они остаются
+        while len(self._sessions) > self.max_entries:
+            self._sessions.popitem(last=False)
+
+    def sweep(self) -> int:
+        """Удаляет просроченные сессии из памяти и с диска"""
+        cutoff = time.time() - self.ttl
+        expired = 0
+        # OrderedDict упорядочен по последней активности — просроченные в начале
+        while self._sessions:
+            user_id, session = next(iter(self._sessions.items()))
+            if session.touched > cutoff:
+                break
+            self._sessions.popitem(last=False)
+            expired += 1
+        if self._store:
+            expired += self._store.sweep_sessions(cutoff)
+        return expired
+
+    async def sweep_loop(self):
+        while True:
+            await asyncio.sleep(SESSION_SWEEP_INTERVAL)
+            expired = self.sweep()
+            if expired:
+                logger.info(f"🧹 Удалено просроченных сессий: {expired}")
+
+USER_STATE = SessionStore(STATE_STORE)
+
+SESSIONS_IN_MEMORY = Gauge("bot_user_state_sessions", "Сессии пользователей в памяти", collect=lambda: len(USER_STATE))
+# ==============================
+# 📚 CATALOG (TESTS & MATERIALS)
+# ==============================
+# Тесты и материалы лежат в JSON-каталоге рядом с ботом. Каталог
+# проверяется при загрузке, а изменения файла подхватываются на лету:
+# новый каталог подменяет старый целиком вместе с кэшем экранов.
+CATALOG_PATH = os.getenv("CATALOG_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "catalog.json"))
+CATALOG_RELOAD_INTERVAL = float(os.getenv("CATALOG_RELOAD_INTERVAL", 5))
+
+TESTS = {}
+MATERIALS = {}
+# Вопросы по (ключ теста, номер вопроса)
+QUESTIONS = {}
+
+def validate_catalog(catalog: dict):
+    """Проверяет структуру каталога; при ошибке бросает ValueError"""
+    if not isinstance(catalog, dict):
+        raise ValueError("каталог должен быть объектом")
+    tests = catalog.get("tests")
+    materials = catalog.get("materials")
+    if not isinstance(tests, dict) or not tests:
+        raise ValueError("нет ни одного теста ('tests')")
+    if not isinstance(materials, dict):
+        raise ValueError("'materials' должен быть объектом")
+
+    for test_key, test in tests.items():
+        if CALLBACK_SEPARATOR in test_key:
+            raise ValueError(f"ключ теста '{test_key}' содержит '{CALLBACK_SEPARATOR}'")
+        if not isinstance(test, dict):
+            raise ValueError(f"тест '{test_key}' должен быть объектом")
+        if not isinstance(test.get("title"), str) or not test["title"]:
+            raise ValueError(f"у теста '{test_key}' нет названия")
+        questions = test.get("questions")
+        if not isinstance(questions, list) or not questions:
+            raise ValueError(f"у теста '{test_key}' нет вопросов")
+        for q_index, question in enumerate(questions, start=1):
+            where = f"тест '{test_key}', вопрос {q_index}"
+            if not isinstance(question, dict):
+                raise ValueError(f"{where}: вопрос должен быть объектом")
+            if not isinstance(question.get("question"), str) or not question["question"]:
+                raise ValueError(f"{where}: пустой текст вопроса")
+            options = question.get("options")
+            if not isinstance(options, list) or len(options) < 2 or not all(isinstance(o, str) and o for o in options):
+                raise ValueError(f"{where}: нужно не меньше двух непустых вариантов ответа")
+            if len(options) > MAX_ANSWER_OPTIONS:
+                raise ValueError(f"{where}: больше {MAX_ANSWER_OPTIONS} вариантов ответа")
+            correct = question.get("correct")
+            # bool — подкласс int, но true/false в каталоге — явная ошибка
+            if not isinstance(correct, int) or isinstance(correct, bool) or not 0 <= correct < len(options):
+                raise ValueError(f"{where}: 'correct' должен быть номером варианта из списка")
+
+    for material_key, material in materials.items():
+        if CALLBACK_SEPARATOR in material_key:
+            raise ValueError(f"ключ материала '{material_key}' содержит '{CALLBACK_SEPARATOR}'")
+        if not isinstance(material, dict):
+            raise ValueError(f"материал '{material_key}' должен быть объектом")
+        for field in ("button", "text"):
+            if not isinstance(material.get(field), str) or not material[field]:
+                raise ValueError(f"у материала '{material_key}' нет поля '{field}'")
+        if material.get("test") not in tests:
+            raise ValueError(f"материал '{material_key}' ссылается на неизвестный тест '{material.get('test')}'")
+
+def load_catalog(path: str = CATALOG_PATH) -> dict:
+    """Читает и проверяет каталог из файла"""
+    with open(path, encoding="utf-8") as f:
+        catalog = json.load(f)
+    validate_catalog(catalog)
+    return catalog
+
+# ==============================
+# 🔗 CALLBACK DATA CODEC
+# ==============================
+# callback_data: "<версия>:<действие>[:<аргумент>...]", не длиннее 64 байт
+# (ограничение Telegram). Аргументы не должны содержать ":".
+CALLBACK_VERSION = "1"
+CALLBACK_SEPARATOR = ":"
+CALLBACK_MAX_BYTES = 64
+
+CB_MAIN_MENU = "m"
+CB_ABOUT = "ab"
+CB_TRAINING = "tr"
+CB_MATERIAL = "mt"
+CB_START_TEST = "st"
+CB_ANSWER = "an"
+
+# Кнопки в сообщениях, отправленных до появления версий
+LEGACY_CALLBACKS = {
+    'back_to_main': (CB_MAIN_MENU, []),
+    'about': (CB_ABOUT, []),
+    'menu_training': (CB_TRAINING, []),
 }
 
+def new_answer_nonce() -> str:
+    """Одноразовый токен показа вопроса"""
+    return secrets.token_hex(4)
+
+def encode_callback(action: str, *args) -> str:
+    """Кодирует действие кнопки в callback_data"""
+    data = CALLBACK_SEPARATOR.join([CALLBACK_VERSION, action, *map(str, args)])
+    if len(data.encode("utf-8")) > CALLBACK_MAX_BYTES:
+        raise ValueError(f"callback_data длиннее {CALLBACK_MAX_BYTES} байт: {data}")
+    return data
+
+def decode_callback(data: str):
+    """Разбирает callback_data в (действие, аргументы); неизвестный формат — (None, [])"""
+    version, _, payload = data.partition(CALLBACK_SEPARATOR)
+    if version == CALLBACK_VERSION and payload:
+        action, *args = payload.split(CALLBACK_SEPARATOR)
+        return action, args
+    return LEGACY_CALLBACKS.get(data, (None, []))
+
+# ==============================
+# 🔤 ANSWER ENCODING
+# ==============================
+# Ответы попытки — строка, символ на вопрос: буква выбранного варианта
+# (a — первый), заглавная, если ответ верный. "BaC": на первый и третий
+# вопросы ответили верно (варианты 2 и 3), на второй — неверно (вариант 1).
+# Из записей старого формата "[True, False]" известна только верность
+# ответа: "+" — верно, "-" — неверно. Любой другой символ (ячейку могли
+# поправить руками) читается как неверный ответ без известного варианта,
+# чтобы не сдвигать номера следующих вопросов.
+ANSWER_LETTERS = "abcdefghijklmnopqrstuvwxyz"
+MAX_ANSWER_OPTIONS = len(ANSWER_LETTERS)
+LEGACY_CORRECT = "+"
+LEGACY_WRONG = "-"
+
+def encode_answer(option: int, is_correct: bool) -> str:
+    letter = ANSWER_LETTERS[option]
+    return letter.upper() if is_correct else letter
+
+def decode_answer(char: str) -> tuple:
+    """(номер варианта или None, верен ли ответ)"""
+    if char == LEGACY_CORRECT:
+        return None, True
+    if char == LEGACY_WRONG:
+        return None, False
+    option = ANSWER_LETTERS.find(char.lower())
+    if option < 0:
+        return None, False
+    return option, char.isupper()
+
+def normalize_answers(answers) -> str:
+    """Ответы в текущем формате из строки или прежнего списка булевых значений"""
+    if isinstance(answers, list):
+        return "".join(LEGACY_CORRECT if value else LEGACY_WRONG for value in answers)
+    answers = answers.strip()
+    if answers.startswith("["):
+        tokens = (token.strip() for token in answers.strip("[]").split(","))
+        return "".join(LEGACY_CORRECT if token == "True" else LEGACY_WRONG for token in tokens if token)
+    return answers
+
+# ==============================
+# 🎨 RENDER CACHE
+# ==============================
+# Меню, материалы и вопросы статичны: текст и разметка собираются один раз
+# на каждую версию каталога и переиспользуются на каждом нажатии.
+Screen = namedtuple("Screen", ["text", "reply_markup", "parse_mode"])
+
+# Вопрос: текст готов заранее, а клавиатура собирается при показе —
+# в кнопках одноразовый токен сессии (см. question_markup)
+QuestionScreen = namedtuple("QuestionScreen", ["text", "options", "parse_mode"])
+
+def render_question(tests: dict, test_key: str, q_index: int) -> QuestionScreen:
+    """Экран вопроса теста"""
+    questions = tests[test_key]['questions']
+    question_data = questions[q_index]
+    text = f"📝 *Вопрос {q_index + 1} из {len(questions)}:*\n\n{question_data['question']}"
+    return QuestionScreen(text, tuple(question_data['options']), "Markdown")
+
+def question_markup(screen: QuestionScreen, nonce: str) -> InlineKeyboardMarkup:
+    """Клавиатура вопроса: в callback_data только токен показа и номер варианта"""
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(option, callback_data=encode_callback(CB_ANSWER, nonce, i))]
+        for i, option in enumerate(screen.options)
+    ])
+
+def build_screens(tests: dict, materials: dict) -> dict:
+    """Собирает все статичные экраны бота для каталога"""
+    screens = {}
+
+    screens['main_menu'] = Screen(
+        "👋 Добро пожаловать в бот обучения партнёров ПВЗ!",
+        InlineKeyboardMarkup([
+            [InlineKeyboardButton("📚 Обучение", callback_data=encode_callback(CB_TRAINING))],
+            [InlineKeyboardButton("ℹ️ О боте", callback_data=encode_callback(CB_ABOUT))],
+        ]),
+        None
+    )
+
+    screens['about'] = Screen(
+        "🎓 *Бот обучения партнёров ПВЗ*\n"
+        "Интерактивная платформа для обучения и тестирования сотрудников пунктов выдачи заказов.\n\n"
+        "© 2025 Команда разработки",
+        InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data=encode_callback(CB_MAIN_MENU))]]),
+        "Markdown"
+    )
+
+    keyboard = [
+        [InlineKeyboardButton(material['button'], callback_data=encode_callback(CB_MATERIAL, material_key))]
+        for material_key, material in materials.items()
+    ]
+    keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data=encode_callback(CB_MAIN_MENU))])
+    screens['training'] = Screen("📚 *Выберите обучающий материал:*", InlineKeyboardMarkup(keyboard), "Markdown")
+
+    for material_key, material in materials.items():
+        screens[('material', material_key)] = Screen(
+            material['text'],
+            InlineKeyboardMarkup([
+                [InlineKeyboardButton("✅ Пройти тест", callback_data=encode_callback(CB_START_TEST, material['test']))],
+                [InlineKeyboardButton("🔙 Назад к материалам", callback_data=encode_callback(CB_TRAINING))],
+            ]),
+            "Markdown"
+        )
+
+    for test_key, test in tests.items():
+        for q_index in range(len(test['questions'])):
+            screens[('question', test_key, q_index)] = render_question(tests, test_key, q_index)
+    # Проверяем заранее, что callback_data ответа укладывается в лимит
+    encode_callback(CB_ANSWER, new_answer_nonce(), max(
+        (len(q['options']) for test in tests.values() for q in test['questions']), default=1
+    ))
+
+    # Текст результата зависит от баллов, клавиатура — нет
+    screens['test_result'] = Screen(
+        None,
+        InlineKeyboardMarkup([
+            [InlineKeyboardButton("📚 Вернуться к материалам", callback_data=encode_callback(CB_TRAINING))],
+            [InlineKeyboardButton("🏠 В главное меню", callback_data=encode_callback(CB_MAIN_MENU))],
+        ]),
+        "Markdown"
+    )
+    return screens
+
+SCREENS = {}
+
+def apply_catalog(catalog: dict):
+    """Делает каталог текущим вместе с индексом вопросов и кэшем экранов"""
+    global TESTS, MATERIALS, QUESTIONS, SCREENS
+    tests, materials = catalog["tests"], catalog["materials"]
+    # Всё собирается заранее: ошибка сборки оставит прежний каталог
+    screens = build_screens(tests, materials)
+    questions = {
+        (test_key, q_index): question
+        for test_key, test in tests.items()
+        for q_index, question in enumerate(test['questions'])
+    }
+    # Подмена без await между присваиваниями — обработчики видят либо
+    # старый, либо новый каталог целиком
+    TESTS, MATERIALS, QUESTIONS, SCREENS = tests, materials, questions, screens
+    logger.info(f"📚 Каталог загружен: тестов — {len(tests)}, материалов — {len(materials)}, экранов — {len(screens)}")
+
+def catalog_mtime() -> float:
+    try:
+        return os.stat(CATALOG_PATH).st_mtime
+    except OSError:
+        return 0.0
+
+async def watch_catalog():
+    """Следит за файлом каталога и перезагружает его при изменении"""
+    last_mtime = catalog_mtime()
+    while True:
+        await asyncio.sleep(CATALOG_RELOAD_INTERVAL)
+        mtime = catalog_mtime()
+        if not mtime or mtime == last_mtime:
+            continue
+        last_mtime = mtime
+        try:
+            apply_catalog(load_catalog())
+        except (OSError, ValueError) as e:
+            # json.JSONDecodeError — тоже ValueError
+            logger.error(f"❌ Каталог не перезагружен, остаётся прежний: {e}")
+        except Exception as e:
+            # Непредвиденная ошибка не должна навсегда выключать перезагрузку
+            logger.exception(f"❌ Каталог не перезагружен, остаётся прежний: {e}")
+
+try:
+    apply_catalog(load_catalog())
+except (OSError, ValueError) as e:
+    logger.error(f"❌ Не удалось загрузить каталог {CATALOG_PATH}: {e}")
+    exit(1)
+
+# ==============================
+# 🧭 CONVERSATION STATE MACHINE
+# ==============================
+# Диалог описан таблицей переходов {(состояние, событие): Transition}.
+# Правила объявляются декоратором CONVERSATION.on(...) рядом с обработчиками
+# и собираются в словарь в build_application(): переход — один поиск по
+# ключу. Состояние — строка в Session.state (None — свободный диалог),
+# поэтому сессия сохраняется как есть.
+STATE_IDLE = None
+STATE_TESTING = "testing"
+
+EVENT_TEXT = "text"
+EVENT_START_TEST = "start_test"
+EVENT_ANSWER = "answer"
+EVENT_FINISH_TEST = "finish_test"
+EVENT_DROP_TEST = "drop_test"
+
+# Правило для всех известных состояний; явные правила важнее
+ANY_STATE = "*"
+# Переход без смены состояния
+STAY = object()
+
+# handler(update, context, session, *аргументы события) -> bool: False —
+# событие отклонено (например, не прошла проверка ввода), состояние не меняется
+Transition = namedtuple("Transition", ("handler", "target"))
+
+class ConversationMachine:
+    """Конечный автомат диалога с таблицей переходов"""
+
+    def __init__(self):
+        self._rules = []
+        self._table = None
+        self.states = {STATE_IDLE}
+
+    def add(self, states, event: str, handler, target=STAY):
+        """Добавляет правило: в состояниях states событие event обрабатывает handler"""
+        states = tuple(states) if isinstance(states, (list, tuple, set)) else (states,)
+        self._rules.append((states, event, Transition(handler, target)))
+        self.states.update(state for state in states if state != ANY_STATE)
+        if target is not STAY:
+            self.states.add(target)
+
+    def on(self, states, event: str, target=STAY):
+        """Декоратор для add()"""
+        def decorator(handler):
+            self.add(states, event, handler, target)
+            return handler
+        return decorator
+
+    def compile(self):
+        """Раскрывает ANY_STATE и собирает таблицу переходов"""
+        table = {}
+        # Сначала правила для всех состояний, чтобы явные их перекрыли
+        for states, event, transition in sorted(self._rules, key=lambda rule: rule[0] != (ANY_STATE,)):
+            for state in (self.states if states == (ANY_STATE,) else states):
+                table[(state, event)] = transition
+        self._table = table
+
+    async def dispatch(self, event: str, update: Update, context: ContextTypes.DEFAULT_TYPE,
+                       session: Session, *args) -> bool:
+        """Применяет событие к сессии; False — перехода нет или он отклонён
+
+        Новое состояние выставляется до вызова обработчика, чтобы он сохранил
+        его вместе с остальными изменениями сессии (USER_STATE.save).
+        """
+        transition = self._table.get((session.state, event))
+        if transition is None:
+            return False
+        previous = session.state
+        if transition.target is not STAY:
+            session.state = transition.target
+        if not await transition.handler(update, context, session, *args):
+            session.state = previous
+            return False
+        return True
+
+CONVERSATION = ConversationMachine()
+
+# Шаг анкеты: в состоянии state текст пользователя записывается в поле
+# сессии field. prompt — вопрос шага, в нём доступны поля сессии ({fio});
+# validate(text) -> bool и error — необязательная проверка ввода. Новый шаг
+# (телефон, код ПВЗ) — ещё один FormStep и поле в Session.__slots__.
+FormStep = namedtuple("FormStep", ("state", "field", "prompt", "validate", "error"), defaults=(None, None))
+
+def render_prompt(step: FormStep, session: Session) -> str:
+    return step.prompt.format(**{name: getattr(session, name) for name in Session.__slots__})
+
+async def fill_form_step(step: FormStep, next_step: FormStep, on_complete,
+                         update: Update, context: ContextTypes.DEFAULT_TYPE, session: Session, text: str) -> bool:
+    if step.validate and not step.validate(text):
+        await update.message.reply_text(step.error or "Проверьте введённые данные и попробуйте ещё раз.")
+        return False
+    setattr(session, step.field, text)
+    USER_STATE.save(update.effective_user.id)
+    if next_step:
+        await update.message.reply_text(render_prompt(next_step, session))
+    else:
+        await on_complete(update, context, session)
+    return True
+
+def add_form(machine: ConversationMachine, steps: tuple, on_complete):
+    """Добавляет анкету: шаги по порядку, после последнего — on_complete(update, context, session)"""
+    for step, next_step in zip(steps, steps[1:] + (None,)):
+        target = next_step.state if next_step else STATE_IDLE
+        machine.add(step.state, EVENT_TEXT, functools.partial(fill_form_step, step, next_step, on_complete), target)
+
 # ==============================
 # 🎯 COMMAND HANDLERS
 # ==============================
+@timed("start")
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     user_id = user.id
@@ -185,8 +1041,9 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if is_user_registered(user_id):
         await show_main_menu(update, context)
     else:
-        USER_STATE[user_id] = {"state": "awaiting_fio"}
-        await update.message.reply_text("👋 Добро пожаловать!\nПожалуйста, введите ваше ФИО:")
+        first_step = REGISTRATION_STEPS[0]
+        session = USER_STATE.create(user_id, state=first_step.state)
+        await update.message.reply_text(render_prompt(first_step, session))
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     help_text = (
@@ -196,216 +1053,485 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "/about — о боте\n\n"
         "Сначала необходимо зарегистрироваться (ФИО, город ПВЗ)."
     )
+    if update.effective_user.id == ADMIN_ID:
+        help_text += (
+            "\n\n🔐 *Администратору:*\n"
+            "/stats — сдача по тестам\n"
+            "/cities — прохождение по городам\n"
+            "/nopass — кто ещё не сдал ни одного теста\n"
+            "/items — решаемость вопросов и выбор вариантов\n"
+            "/answers — ответы по вопросам в CSV\n"
+            "/broadcast — рассылка всем партнёрам\n"
+            "/remind — напоминание тем, кто не сдал тест"
+        )
     await update.message.reply_text(help_text, parse_mode="Markdown")
 
 async def about(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    about_text = (
-        "🎓 *Бот обучения партнёров ПВЗ*\n"
-        "Интерактивная платформа для обучения и тестирования сотрудников пунктов выдачи заказов.\n\n"
-        "© 2025 Команда разработки"
-    )
-    keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data='back_to_main')]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    screen = SCREENS['about']
     if update.message:
-        await update.message.reply_text(about_text, parse_mode="Markdown", reply_markup=reply_markup)
+        await update.message.reply_text(screen.text, parse_mode=screen.parse_mode, reply_markup=screen.reply_markup)
     else:
-        await update.callback_query.edit_message_text(about_text, parse_mode="Markdown", reply_markup=reply_markup)
+        await update.callback_query.edit_message_text(screen.text, parse_mode=screen.parse_mode, reply_markup=screen.reply_markup)
 
 # ==============================
-# 📝 TEXT HANDLER (for FIO and City)
+# 🔐 ADMIN ANALYTICS
 # ==============================
-async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user = update.effective_user
-    user_id = user.id
-    text = update.message.text.strip()
-
-    if user_id not in USER_STATE:
-        await update.message.reply_text("Пожалуйста, начните с команды /start")
-        return
+# Команды доступны только ADMIN_ID (фильтр в build_application) и читают
+# агрегаты хранилища, а не лист "Тесты"
+NOPASS_LIST_LIMIT = 50
 
-    state = USER_STATE[user_id].get("state")
+# Telegram принимает до 4096 символов в сообщении; оставляем запас
+MESSAGE_CHUNK_LIMIT = 4000
 
-    if state == "awaiting_fio":
-        USER_STATE[user_id]["fio"] = text
-        USER_STATE[user_id]["state"] = "awaiting_city"
-        await update.message.reply_text(f"Спасибо, {text}!\nТеперь введите город вашего ПВЗ:")
+def percent(part: int, whole: int) -> str:
+    return f"{part / whole:.0%}" if whole else "—"
 
-    elif state == "awaiting_city":
-        USER_STATE[user_id]["city"] = text
-        USER_STATE[user_id]["username"] = user.username or "unknown"
-        
-        # Сохраняем пользователя в Google Таблицу
-        if save_user_to_sheet(user_id, USER_STATE[user_id]):
-            await update.message.reply_text(
-                f"✅ Регистрация завершена!\n\n"
-                f"ФИО: {USER_STATE[user_id]['fio']}\n"
-                f"Город ПВЗ: {text}\n\n"
-                f"Теперь вы можете приступить к обучению!"
-            )
-            await show_main_menu(update, context)
+def chunk_lines(lines: list, limit: int = MESSAGE_CHUNK_LIMIT) -> list:
+    """Склеивает строки в тексты не длиннее limit, не разрывая строку без нужды"""
+    chunks, current = [], ""
+    for line in lines:
+        # Строку длиннее лимита режем как есть
+        while len(line) > limit:
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.append(line[:limit])
+            line = line[limit:]
+        if current and len(current) + 1 + len(line) > limit:
+            chunks.append(current)
+            current = line
         else:
-            await update.message.reply_text(
-                "✅ Регистрация завершена локально!\n\n"
-                f"ФИО: {USER_STATE[user_id]['fio']}\n"
-                f"Город ПВЗ: {text}\n\n"
-                "Теперь вы можете приступить к обучению!"
-            )
-            await show_main_menu(update, context)
+            current = f"{current}\n{line}" if current else line
+    if current:
+        chunks.append(current)
+    return chunks
 
-# ==============================
-# 🖱️ CALLBACK HANDLER (Buttons)
-# ==============================
-async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    user = update.effective_user
-    user_id = user.id
+async def reply_lines(update: Update, lines: list):
+    """Отправляет отчёт одним или несколькими сообщениями"""
+    for chunk in chunk_lines(lines):
+        await update.message.reply_text(chunk)
 
-    # Проверка регистрации
-    if not is_user_registered(user_id) and query.data not in ['back_to_main']:
-        await query.edit_message_text("Пожалуйста, сначала зарегистрируйтесь через /start")
+@timed("admin_stats")
+async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    stats = await storage_call(STORAGE.test_stats)
+    if not stats:
+        await update.message.reply_text("📊 Результатов тестов пока нет.")
         return
-
-    # 📚 Меню обучения
-    if query.data == 'menu_training':
-        keyboard = [
-            [InlineKeyboardButton("📦 Приём заказа", callback_data='material_order')],
-            [InlineKeyboardButton("🚚 Отгрузка товара", callback_data='material_shipping')],
-            [InlineKeyboardButton("🔙 Назад", callback_data='back_to_main')],
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text("📚 *Выберите обучающий материал:*", reply_markup=reply_markup, parse_mode="Markdown")
-
-    # 📥 Материал: Приём заказа
-    elif query.data == 'material_order':
-        text = (
-            "📦 *Материал: Приём заказа*\n\n"
-            "*Текстовый мануал:*\n"
-            "1️⃣ Всегда начинайте с приветствия по имени клиента.\n"
-            "2️⃣ Уточните артикул и количество товара.\n"
-            "3️⃣ Согласуйте способ доставки и сроки.\n"
-            "4️⃣ Создайте заказ в CRM-системе.\n"
-            "5️⃣ Отправьте клиенту подтверждение (SMS/email).\n\n"
-            "*Видео-инструкция:* https://youtu.be/example"
+    lines = ["📊 Сдача тестов:"]
+    for row in stats:
+        lines.append(
+            f"\n{row['test_name']}\n"
+            f"  попыток: {row['attempts']}, сдано: {row['passed_attempts']} ({percent(row['passed_attempts'], row['attempts'])})\n"
+            f"  пользователей: {row['users']}, сдали: {row['passed_users']} ({percent(row['passed_users'], row['users'])})"
         )
-        keyboard = [
-            [InlineKeyboardButton("✅ Пройти тест", callback_data='start_test_order')],
-            [InlineKeyboardButton("🔙 Назад к материалам", callback_data='menu_training')],
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(text, parse_mode="Markdown", reply_markup=reply_markup)
-
-    # 📤 Материал: Отгрузка товара
-    elif query.data == 'material_shipping':
-        text = (
-            "🚚 *Материал: Отгрузка товара*\n\n"
-            "*Текстовый мануал:*\n"
-            "1️⃣ Проверьте статус оплаты в системе.\n"
-            "2️⃣ Скомплектуйте заказ на складе.\n"
-            "3️⃣ Передайте посылку службе доставки.\n"
-            "4️⃣ Отсканируйте трек-номер и внесите в систему.\n"
-            "5️⃣ Уведомите клиента о передаче заказа.\n\n"
-            "*Видео-инструкция:* https://youtu.be/example"
+    await reply_lines(update, lines)
+
+@timed("admin_cities")
+async def admin_cities(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    stats = await storage_call(STORAGE.city_stats)
+    if not stats:
+        await update.message.reply_text("🏙️ Зарегистрированных пользователей пока нет.")
+        return
+    lines = ["🏙️ Прохождение по городам (зарегистрировано / проходили / сдали):"]
+    for row in stats:
+        lines.append(
+            f"{row['city']}: {row['registered']} / {row['attempted']} / {row['passed']} "
+            f"({percent(row['passed'], row['registered'])})"
         )
-        keyboard = [
-            [InlineKeyboardButton("✅ Пройти тест", callback_data='start_test_shipping')],
-            [InlineKeyboardButton("🔙 Назад к материалам", callback_data='menu_training')],
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(text, parse_mode="Markdown", reply_markup=reply_markup)
-
-    # 🧠 Начать тест
-    elif query.data.startswith('start_test_'):
-        test_key = query.data.replace('start_test_', '')
-        if test_key in TESTS:
-            USER_STATE[user_id]['test'] = {
-                'key': test_key,
-                'current_question': 0,
-                'score': 0,
-                'answers': []
-            }
-            await send_test_question(update, context, user_id)
-
-    # 📝 Ответ на вопрос теста
-    elif query.data.startswith('answer_'):
-        parts = query.data.split('_')
-        if len(parts) >= 4:
-            test_key = parts[1]
-            q_index = int(parts[2])
-            is_correct = parts[3] == '1'
-            
-            if user_id in USER_STATE and 'test' in USER_STATE[user_id]:
-                user_test = USER_STATE[user_id]['test']
-                user_test['answers'].append(is_correct)
-                
+    await reply_lines(update, lines)
+
+@timed("admin_nopass")
+async def admin_nopass(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    total, users = await storage_call(STORAGE.users_without_pass, NOPASS_LIST_LIMIT)
+    if not total:
+        await update.message.reply_text("✅ Все зарегистрированные сдали хотя бы один тест.")
+        return
+    lines = [f"⏳ Без сданного теста: {total}"]
+    for user in users:
+        lines.append(f"{user['fio']} ({user['city']}), id {user['user_id']}, тестов начато: {user['tests_attempted']}")
+    if total > len(users):
+        lines.append(f"… и ещё {total - len(users)}")
+    await reply_lines(update, lines)
+
+def item_statistics(patterns) -> dict:
+    """Статистика вопросов по строкам ответов
+
+    patterns — [(тест, ответы, сколько попыток), ...]: одинаковые строки
+    ответов сгруппированы, поэтому разбирается каждая лишь раз.
+    Возвращает {тест: [по вопросам {'attempts', 'correct', 'key', 'options'}]},
+    где key — номер верного варианта (если встречался), options — {вариант: сколько раз выбран}.
+    """
+    stats = {}
+    for test_name, answers, count in patterns:
+        items = stats.setdefault(test_name, [])
+        for position, char in enumerate(normalize_answers(answers)):
+            if position == len(items):
+                items.append({"attempts": 0, "correct": 0, "key": None, "options": defaultdict(int)})
+            item = items[position]
+            option, is_correct = decode_answer(char)
+            item["attempts"] += count
+            if is_correct:
+                item["correct"] += count
+            if option is not None:
+                item["options"][option] += count
                 if is_correct:
-                    user_test['score'] += 1
-                
-                # Следующий вопрос или результат
-                user_test['current_question'] += 1
-                if user_test['current_question'] < len(TESTS[test_key]['questions']):
-                    await send_test_question(update, context, user_id)
-                else:
-                    await show_test_result(update, context, user_id)
+                    item["key"] = option
+    return stats
 
-    # ℹ️ О боте
-    elif query.data == 'about':
-        await about(update, context)
+# Вариант, который выбирают реже, — нерабочий дистрактор
+WEAK_DISTRACTOR_SHARE = 0.05
+# На меньшем числе ответов выводы о дистракторах не делаем
+ITEM_MIN_ATTEMPTS = 20
 
-    # 🔙 Назад в главное меню
-    elif query.data == 'back_to_main':
-        await show_main_menu(update, context)
+def describe_item(number: int, item: dict, question: dict = None) -> str:
+    """Решаемость вопроса и выбор вариантов с пометками о проблемных дистракторах"""
+    attempts = item["attempts"]
+    line = f"В{number}: решаемость {percent(item['correct'], attempts)} (n={attempts})"
+    chosen = sum(item["options"].values())
+    if not chosen:
+        return line
+    option_count = len(question["options"]) if question else max(item["options"]) + 1
+    # Верного ответа в данных могло не встретиться — берём его из каталога
+    key = item["key"] if item["key"] is not None or not question else question["correct"]
+    shares, warnings = [], []
+    for option in range(option_count):
+        picks = item["options"][option]
+        mark = " ✓" if option == key else ""
+        shares.append(f"{option + 1}: {percent(picks, chosen)}{mark}")
+        if option == key or chosen < ITEM_MIN_ATTEMPTS:
+            continue
+        if picks < chosen * WEAK_DISTRACTOR_SHARE:
+            warnings.append(f"вариант {option + 1} почти не выбирают")
+        elif key is not None and picks > item["options"][key]:
+            warnings.append(f"вариант {option + 1} выбирают чаще верного")
+    line += "\n  " + ", ".join(shares)
+    if warnings:
+        line += "\n  ⚠️ " + "; ".join(warnings)
+    return line
+
+@timed("admin_items")
+async def admin_items(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    patterns = await storage_call(STORAGE.answer_patterns)
+    stats = item_statistics(patterns)
+    if not stats:
+        await update.message.reply_text("🧮 Результатов тестов пока нет.")
+        return
+    # Вопросы текущего каталога — чтобы показать и ни разу не выбранные варианты
+    catalog = {test['title']: test for test in TESTS.values()}
+    for test_name, items in sorted(stats.items()):
+        questions = catalog.get(test_name, {}).get("questions", [])
+        lines = [f"🧮 {test_name}"]
+        for number, item in enumerate(items, start=1):
+            question = questions[number - 1] if number <= len(questions) else None
+            lines.append(describe_item(number, item, question))
+        await reply_lines(update, lines)
+
+def answers_csv(results: list) -> bytes:
+    """Попытки одного теста по колонкам вопросов: q<N> — выбранный вариант, q<N>_ok — верно ли"""
+    encoded = [normalize_answers(row["answers"]) for row in results]
+    question_count = max((len(answers) for answers in encoded), default=0)
+    header = ["user_id", "fio", "pass_date", "score", "max_score"]
+    for number in range(1, question_count + 1):
+        header += [f"q{number}", f"q{number}_ok"]
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(header)
+    for row, answers in zip(results, encoded):
+        cells = [row[column] for column in header[:5]]
+        for char in answers:
+            option, is_correct = decode_answer(char)
+            cells += ["" if option is None else option + 1, int(is_correct)]
+        writer.writerow(cells)
+    # BOM — чтобы Excel открыл кириллицу без настройки кодировки
+    return buffer.getvalue().encode("utf-8-sig")
+
+def test_answers_csv(test_name: str) -> tuple:
+    """Выгрузка одного теста: (число попыток, CSV)"""
+    rows = STORAGE.query_results(test_name=test_name)
+    return len(rows), answers_csv(rows)
+
+@timed("admin_answers")
+async def admin_answers(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    stats = await storage_call(STORAGE.test_stats)
+    if not stats:
+        await update.message.reply_text("📄 Результатов тестов пока нет.")
+        return
+    test_names = sorted(row["test_name"] for row in stats)
+    for index, test_name in enumerate(test_names, start=1):
+        # Выборка и сборка CSV — вне цикла событий и по одному тесту за раз,
+        # чтобы в памяти не лежали попытки всех тестов сразу
+        if STORAGE.is_remote:
+            attempts, document = await run_sheets_call(test_answers_csv, test_name)
+        else:
+            attempts, document = await asyncio.to_thread(test_answers_csv, test_name)
+        if not attempts:
+            continue
+        await update.message.reply_document(
+            document=document, filename=f"answers_{index}.csv",
+            caption=f"📄 {test_name}: попыток {attempts}"
+        )
 
 # ==============================
-# 🎥 TEST FUNCTIONS
-# ==============================
-async def send_test_question(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int):
-    """Отправляет текущий вопрос теста"""
-    if user_id not in USER_STATE or 'test' not in USER_STATE[user_id]:
+# 📝 TEXT HANDLER (for FIO and City)
+# ==============================
+@timed("handle_text")
+async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    session = USER_STATE.get(update.effective_user.id)
+    if session is None:
+        await update.message.reply_text("Пожалуйста, начните с команды /start")
+        return
+    await CONVERSATION.dispatch(EVENT_TEXT, update, context, session, update.message.text.strip())
+
+async def finish_registration(update: Update, context: ContextTypes.DEFAULT_TYPE, session: Session):
+    """Последний шаг анкеты: сохраняет пользователя и открывает меню"""
+    user_id = update.effective_user.id
+    session.username = update.effective_user.username or "unknown"
+    USER_STATE.save(user_id)
+
+    # Сохраняем пользователя в хранилище
+    if await save_user(user_id, session):
+        await update.message.reply_text(
+            f"✅ Регистрация завершена!\n\n"
+            f"ФИО: {session.fio}\n"
+            f"Город ПВЗ: {session.city}\n\n"
+            f"Теперь вы можете приступить к обучению!"
+        )
+    else:
+        await update.message.reply_text(
+            "⚠️ Не удалось сохранить регистрацию.\n\n"
+            f"ФИО: {session.fio}\n"
+            f"Город ПВЗ: {session.city}\n\n"
+            "Вы можете приступить к обучению, но после перезапуска бота "
+            "регистрацию придётся пройти заново через /start."
+        )
+    await show_main_menu(update, context)
+
+# Состояния анкеты сохраняются в сессиях — их имена не меняем
+REGISTRATION_STEPS = (
+    FormStep("awaiting_fio", "fio", "👋 Добро пожаловать!\nПожалуйста, введите ваше ФИО:"),
+    FormStep("awaiting_city", "city", "Спасибо, {fio}!\nТеперь введите город вашего ПВЗ:"),
+)
+add_form(CONVERSATION, REGISTRATION_STEPS, finish_registration)
+
+# ==============================
+# 🖱️ CALLBACK HANDLER (Buttons)
+# ==============================
+# Обработчики кнопок по коду действия из callback_data:
+# {действие: (обработчик, число аргументов)}
+CALLBACK_ROUTES = {}
+
+def callback_route(action: str):
+    """Регистрирует обработчик кнопки для действия"""
+    def decorator(handler):
+        # Первые два параметра — update и context, остальные приходят из callback_data
+        arity = len(inspect.signature(handler).parameters) - 2
+        CALLBACK_ROUTES[action] = (handler, arity)
+        return handler
+    return decorator
+
+@timed("button")
+async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    user = update.effective_user
+    user_id = user.id
+
+    action, args = decode_callback(query.data)
+
+    # Проверка регистрации
+    if not is_user_registered(user_id) and action != CB_MAIN_MENU:
+        await query.edit_message_text("Пожалуйста, сначала зарегистрируйтесь через /start")
         return
+
+    handler, arity = CALLBACK_ROUTES.get(action, (None, 0))
+    if handler is None or len(args) != arity:
+        # Устаревшая или незнакомая кнопка — возвращаем в меню
+        await show_main_menu(update, context)
+        return
+    await handler(update, context, *args)
+
+# 🔙 Назад в главное меню
+@callback_route(CB_MAIN_MENU)
+async def on_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await show_main_menu(update, context)
+
+# ℹ️ О боте
+@callback_route(CB_ABOUT)
+async def on_about(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await about(update, context)
+
+# 📚 Меню обучения
+@callback_route(CB_TRAINING)
+async def on_training(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    screen = SCREENS['training']
+    await update.callback_query.edit_message_text(screen.text, parse_mode=screen.parse_mode, reply_markup=screen.reply_markup)
+
+# 📥 Обучающий материал
+@callback_route(CB_MATERIAL)
+async def on_material(update: Update, context: ContextTypes.DEFAULT_TYPE, material_key: str):
+    screen = SCREENS.get(('material', material_key))
+    if screen:
+        await update.callback_query.edit_message_text(screen.text, parse_mode=screen.parse_mode, reply_markup=screen.reply_markup)
+
+# 🧠 Начать тест
+@callback_route(CB_START_TEST)
+async def on_start_test(update: Update, context: ContextTypes.DEFAULT_TYPE, test_key: str):
+    if test_key not in TESTS:
+        return
+    # После перезапуска у зарегистрированного пользователя может не быть сессии
+    session = USER_STATE.get_or_create(update.effective_user.id)
+    await CONVERSATION.dispatch(EVENT_START_TEST, update, context, session, test_key)
+
+@CONVERSATION.on(ANY_STATE, EVENT_START_TEST, target=STATE_TESTING)
+async def start_test(update: Update, context: ContextTypes.DEFAULT_TYPE, session: Session, test_key: str) -> bool:
+    session.test = {
+        'key': test_key,
+        'current_question': 0,
+        'score': 0,
+        'answers': ''
+    }
+    USER_STATE.save(update.effective_user.id)
+    await send_test_question(update, context, session)
+    return True
+
+# 📝 Ответ на вопрос теста
+@callback_route(CB_ANSWER)
+async def on_answer(update: Update, context: ContextTypes.DEFAULT_TYPE, nonce: str, option: str):
+    session = USER_STATE.get(update.effective_user.id)
+    if session and session.test:
+        await CONVERSATION.dispatch(EVENT_ANSWER, update, context, session, nonce, option)
+
+# Тесты, начатые до появления состояния STATE_TESTING, идут в состоянии STATE_IDLE
+@CONVERSATION.on(STATE_IDLE, EVENT_ANSWER, target=STATE_TESTING)
+@CONVERSATION.on(STATE_TESTING, EVENT_ANSWER)
+async def answer_question(update: Update, context: ContextTypes.DEFAULT_TYPE, session: Session,
+                          nonce: str, option: str) -> bool:
+    user_test = session.test
+    # Токен меняется при каждом показе вопроса: кнопки прошлых вопросов,
+    # повторные нажатия и чужие callback_data отбрасываются без запросов к API
+    if nonce != user_test.get('nonce'):
+        return False
+    question = QUESTIONS.get((user_test['key'], user_test['current_question']))
+    if question is None or not option.isdigit() or int(option) >= len(question['options']):
+        return False
+    
+    # Правильность считаем по каталогу, а не по данным кнопки
+    is_correct = int(option) == question['correct']
+    user_test['nonce'] = None
+    # Сессии, начатые до смены формата, хранят список булевых значений
+    user_test['answers'] = normalize_answers(user_test['answers']) + encode_answer(int(option), is_correct)
+    
+    if is_correct:
+        user_test['score'] += 1
+    
+    # Следующий вопрос или результат
+    user_test['current_question'] += 1
+    USER_STATE.save(update.effective_user.id)
+    await send_test_question(update, context, session)
+    return True
+
+# ==============================
+# 🎥 TEST FUNCTIONS
+# ==============================
+async def show_test_screen(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int,
+                           session: Session, text: str, reply_markup, parse_mode: str,
+                           priority: int = None):
+    """Показывает экран теста, редактируя сообщение с нажатой кнопкой вместо нового"""
+    fingerprint = zlib.crc32((text + (reply_markup.to_json() if reply_markup else "")).encode("utf-8"))
+    query = update.callback_query
     
-    user_test = USER_STATE[user_id]['test']
+    if query and query.message:
+        message_id = query.message.message_id
+        # То же сообщение с тем же содержимым — запрос к Bot API не нужен
+        if session.screen == [message_id, fingerprint]:
+            return
+        try:
+            await context.bot.edit_message_text(
+                text, chat_id=user_id, message_id=message_id, parse_mode=parse_mode,
+                reply_markup=reply_markup, rate_limit_args=priority
+            )
+            session.screen = [message_id, fingerprint]
+            USER_STATE.save(user_id)
+            return
+        except BadRequest as e:
+            if "not modified" in str(e).lower():
+                session.screen = [message_id, fingerprint]
+                USER_STATE.save(user_id)
+                return
+            # Сообщение слишком старое или удалено — отправим новое
+            logger.warning(f"⚠️ Не удалось отредактировать сообщение {message_id}: {e}")
+    
+    message = await context.bot.send_message(
+        chat_id=user_id, text=text, parse_mode=parse_mode, reply_markup=reply_markup, rate_limit_args=priority
+    )
+    session.screen = [message.message_id, fingerprint]
+    USER_STATE.save(user_id)
+
+@timed("send_test_question")
+async def send_test_question(update: Update, context: ContextTypes.DEFAULT_TYPE, session: Session):
+    """Отправляет текущий вопрос теста"""
+    user_id = update.effective_user.id
+    user_test = session.test
     test_key = user_test['key']
     q_index = user_test['current_question']
     
-    if q_index >= len(TESTS[test_key]['questions']):
-        await show_test_result(update, context, user_id)
+    # Тест могли убрать из каталога, пока пользователь его проходил
+    if test_key not in TESTS:
+        await CONVERSATION.dispatch(EVENT_DROP_TEST, update, context, session)
         return
     
-    question_data = TESTS[test_key]['questions'][q_index]
-    
-    keyboard = []
-    for i, option in enumerate(question_data['options']):
-        callback_data = f"answer_{test_key}_{q_index}_{'1' if i == question_data['correct'] else '0'}"
-        keyboard.append([InlineKeyboardButton(option, callback_data=callback_data)])
+    if q_index >= len(TESTS[test_key]['questions']):
+        await CONVERSATION.dispatch(EVENT_FINISH_TEST, update, context, session)
+        return
     
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    text = f"📝 *Вопрос {q_index + 1} из {len(TESTS[test_key]['questions'])}:*\n\n{question_data['question']}"
+    screen = SCREENS[('question', test_key, q_index)]
+    # Пока на вопрос не ответили, токен прежний — повторный показ ничего не меняет
+    if not user_test.get('nonce'):
+        user_test['nonce'] = new_answer_nonce()
     
-    # Отправляем новый вопрос как новое сообщение
-    await context.bot.send_message(chat_id=user_id, text=text, parse_mode="Markdown", reply_markup=reply_markup)
+    await show_test_screen(
+        update, context, user_id, session,
+        screen.text, question_markup(screen, user_test['nonce']), screen.parse_mode
+    )
+
+@CONVERSATION.on(STATE_TESTING, EVENT_DROP_TEST, target=STATE_IDLE)
+async def drop_test(update: Update, context: ContextTypes.DEFAULT_TYPE, session: Session) -> bool:
+    user_id = update.effective_user.id
+    session.test = None
+    USER_STATE.save(user_id)
+    await context.bot.send_message(chat_id=user_id, text="Этот тест больше недоступен. Выберите материал заново: /start")
+    return True
 
-async def show_test_result(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int):
+@CONVERSATION.on(STATE_TESTING, EVENT_FINISH_TEST, target=STATE_IDLE)
+async def show_test_result(update: Update, context: ContextTypes.DEFAULT_TYPE, session: Session) -> bool:
     """Показывает результат теста"""
-    if user_id not in USER_STATE or 'test' not in USER_STATE[user_id]:
-        return
-    
-    user_test = USER_STATE[user_id]['test']
+    user_id = update.effective_user.id
+    user_test = session.test
     test_key = user_test['key']
     total_questions = len(TESTS[test_key]['questions'])
     score = user_test['score']
     
-    # Сохраняем результат в Google Таблицу
-    if 'fio' in USER_STATE[user_id]:
-        save_test_result_to_sheet(
+    # После перезапуска ФИО в памяти нет — берём его из хранилища
+    if not session.fio:
+        profile = await get_user(user_id)
+        if profile:
+            session.fio = profile['fio']
+    
+    # Сохраняем результат в хранилище
+    if session.fio:
+        await save_test_result(
             user_id=user_id,
-            fio=USER_STATE[user_id]['fio'],
+            fio=session.fio,
             test_name=TESTS[test_key]['title'],
             score=score,
             max_score=total_questions,
-            answers=user_test['answers']
+            answers=normalize_answers(user_test['answers'])
         )
     
+    # Завершённый тест больше не нужен в сессии
+    session.test = None
+    USER_STATE.save(user_id)
+    
     text = (
         f"🎉 *Тест завершён!*\n\n"
         f"Тест: {TESTS[test_key]['title']}\n"
@@ -414,140 +1540,1567 @@ async def show_test_result(update: Update, context: ContextTypes.DEFAULT_TYPE, u
     
     if score == total_questions:
         text += "🌟 Отлично! Вы прекрасно справились!"
-    elif score >= total_questions * 0.7:
+    elif is_passing(score, total_questions):
         text += "👍 Хорошо! Почти всё правильно."
     else:
         text += "📚 Нужно повторить материал."
     
-    keyboard = [
-        [InlineKeyboardButton("📚 Вернуться к материалам", callback_data='menu_training')],
-        [InlineKeyboardButton("🏠 В главное меню", callback_data='back_to_main')],
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    await context.bot.send_message(chat_id=user_id, text=text, parse_mode="Markdown", reply_markup=reply_markup)
+    screen = SCREENS['test_result']
+    # Результат теста важнее остальных ответов — пропускаем его вперёд
+    await show_test_screen(
+        update, context, user_id, session, text, screen.reply_markup, screen.parse_mode, priority=PRIORITY_HIGH
+    )
+    return True
 
 # ==============================
 # 🖥️ MAIN MENU & UTILS
 # ==============================
 async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показывает главное меню"""
-    keyboard = [
-        [InlineKeyboardButton("📚 Обучение", callback_data='menu_training')],
-        [InlineKeyboardButton("ℹ️ О боте", callback_data='about')],
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-
-    text = "👋 Добро пожаловать в бот обучения партнёров ПВЗ!"
+    screen = SCREENS['main_menu']
     
     if update.message:
-        await update.message.reply_text(text, reply_markup=reply_markup)
+        await update.message.reply_text(screen.text, reply_markup=screen.reply_markup)
     elif update.callback_query:
-        await update.callback_query.edit_message_text(text, reply_markup=reply_markup)
+        await update.callback_query.edit_message_text(screen.text, reply_markup=screen.reply_markup)
 
 def is_user_registered(user_id: int) -> bool:
-    """Проверяет, зарегистрирован ли пользователь"""
-    if USERS_SHEET:
-        try:
-            cell = USERS_SHEET.find(str(user_id))
-            return cell is not None
-        except Exception as e:
-            logger.error(f"❌ Ошибка поиска пользователя в таблице: {e}")
+    """Проверяет, зарегистрирован ли пользователь (по индексу в памяти)"""
+    if user_id in REGISTERED_USERS:
+        return True
+
+    # Промах индекса: пользователя могла зарегистрировать другая реплика.
+    # Локальная база отвечает по первичному ключу — это дёшево.
+    if not STORAGE.is_remote and STORAGE.get_user(user_id):
+        mark_user_registered(user_id)
+        return True
     
-    # Fallback на временное хранилище
-    return user_id in USER_STATE and "city" in USER_STATE[user_id]
+    # Fallback на сессию (регистрация не сохранилась в хранилище)
+    session = USER_STATE.get(user_id)
+    return session is not None and bool(session.city)
 
-def save_user_to_sheet(user_id: int, user_data: dict) -> bool:
-    """Сохраняет пользователя в Google Таблицу"""
-    if not USERS_SHEET:
-        logger.error("❌ USERS_SHEET не инициализирован")
-        return False
+async def save_user(user_id: int, session: Session) -> bool:
+    """Сохраняет пользователя в хранилище"""
+    # Логируем что пытаемся сохранить
+    logger.info(f"📝 Сохраняем пользователя {user_id}: {session.fio}")
     
     try:
-        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        
-        # Логируем что пытаемся сохранить
-        logger.info(f"📝 Сохраняем пользователя {user_id}: {user_data.get('fio', '')}")
-        
-        USERS_SHEET.append_row([
-            str(user_id),
-            user_data.get("username", ""),
-            user_data.get("fio", ""),
-            user_data.get("city", ""),
-            now,
-            now
-        ])
-        logger.info(f"✅ Пользователь {user_id} успешно сохранён в Google Таблицу")
-        return True
+        await storage_call(
+            STORAGE.register_user,
+            user_id,
+            session.username or "",
+            session.fio or "",
+            session.city or ""
+        )
     except Exception as e:
         logger.error(f"❌ Ошибка сохранения пользователя {user_id}: {e}")
         return False
+    mark_user_registered(user_id)
+    notify_export("users")
+    return True
 
-def save_test_result_to_sheet(user_id: int, fio: str, test_name: str, score: int, max_score: int, answers: list) -> bool:
-    """Сохраняет результат теста в Google Таблицу"""
-    if not TESTS_SHEET:
-        logger.error("❌ TESTS_SHEET не инициализирован")
-        return False
-    
+async def save_test_result(user_id: int, fio: str, test_name: str, score: int, max_score: int, answers: str) -> bool:
+    """Сохраняет результат теста в хранилище"""
     try:
-        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        
-        TESTS_SHEET.append_row([
-            str(user_id),
-            fio,
-            test_name,
-            str(score),
-            str(max_score),
-            now,
-            str(answers)
-        ])
-        logger.info(f"✅ Результат теста для {user_id} сохранён")
-        return True
+        await storage_call(STORAGE.record_result, user_id, fio, test_name, score, max_score, answers)
     except Exception as e:
         logger.error(f"❌ Ошибка сохранения результата теста: {e}")
         return False
+    notify_export("results")
+    logger.info(f"✅ Результат теста для {user_id} сохранён")
+    return True
+
+async def get_user(user_id: int):
+    """Возвращает анкету пользователя из хранилища или None"""
+    try:
+        return await storage_call(STORAGE.get_user, user_id)
+    except Exception as e:
+        logger.error(f"❌ Ошибка чтения пользователя {user_id}: {e}")
+        return None
 
 # ==============================
-# 🚀 MAIN FUNCTION
+# ⚡ ASYNC SHEETS I/O
 # ==============================
-def main():
-    logger.info("🚀 Запуск Бота обучения партнёров ПВЗ...")
-    
-    # Проверяем инициализацию Google Sheets
-    if USERS_SHEET and TESTS_SHEET:
-        logger.info("✅ Google Таблицы готовы к работе")
+# gspread синхронный: каждый HTTP-запрос выполняется в ограниченном пуле
+# потоков, чтобы медленный ответ Google не останавливал event loop
+SHEETS_MAX_WORKERS = int(os.getenv("SHEETS_MAX_WORKERS", 4))
+SHEETS_CALL_TIMEOUT = float(os.getenv("SHEETS_CALL_TIMEOUT", 10))
+SHEETS_EXECUTOR = ThreadPoolExecutor(max_workers=SHEETS_MAX_WORKERS, thread_name_prefix="sheets")
+
+async def run_sheets_call(func, *args, **kwargs):
+    """Выполняет синхронный вызов Google Таблиц в пуле потоков с таймаутом"""
+    operation = getattr(func, "__name__", "call")
+    loop = asyncio.get_running_loop()
+    future = loop.run_in_executor(SHEETS_EXECUTOR, functools.partial(func, *args, **kwargs))
+    started = time.perf_counter()
+    status = "ok"
+    try:
+        return await asyncio.wait_for(future, timeout=SHEETS_CALL_TIMEOUT)
+    except asyncio.TimeoutError:
+        status = "timeout"
+        raise
+    except Exception as e:
+        status = str(sheets_error_status(e) or "error")
+        raise
+    finally:
+        SHEETS_LATENCY.observe(time.perf_counter() - started, operation)
+        SHEETS_CALLS.inc(operation, status)
+
+SHEETS_QUEUE_DEPTH = Gauge(
+    "bot_sheets_executor_queue", "Вызовы Google Таблиц, ждущие свободного потока",
+    collect=lambda: SHEETS_EXECUTOR._work_queue.qsize()
+)
+
+# ==============================
+# 🗄️ STORAGE
+# ==============================
+# Основное хранилище — локальная SQLite (WAL, synchronous=FULL): запись
+# и чтение на горячем пути — это операции с индексом на диске, а листы
+# "Пользователи"/"Тесты" остаются выгрузкой. STORAGE_BACKEND=sheets
+# возвращает прежнюю схему, где таблица — единственное хранилище.
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sqlite")
+DB_PATH = os.getenv("DB_PATH", "bot_data.db")
+
+EXPORT_PENDING = 0
+EXPORT_DONE = 1
+EXPORT_REJECTED = 2
+
+def now_str() -> str:
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+# Доля правильных ответов, с которой тест считается сданным
+PASS_THRESHOLD = 0.7
+
+def is_passing(score: int, max_score: int) -> bool:
+    return max_score > 0 and score >= max_score * PASS_THRESHOLD
+
+class ResultStats:
+    """Агрегаты для аналитики, которые обновляются при каждой записи
+
+    Живут в таблицах stats_* на переданном соединении SQLite. Методы
+    on_* вызываются под блокировкой и в транзакции владельца соединения,
+    поэтому агрегаты всегда согласованы с самими данными.
+    """
+
+    def __init__(self, conn: sqlite3.Connection):
+        self._conn = conn
+
+    def create_schema(self) -> bool:
+        """Создаёт таблицы агрегатов; True, если их ещё не было"""
+        fresh = self._conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'stats_tests'"
+        ).fetchone() is None
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS stats_tests (
+                test_name TEXT PRIMARY KEY,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                passed_attempts INTEGER NOT NULL DEFAULT 0,
+                users INTEGER NOT NULL DEFAULT 0,
+                passed_users INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS stats_user_tests (
+                user_id INTEGER NOT NULL,
+                test_name TEXT NOT NULL,
+                attempts INTEGER NOT NULL,
+                best_score INTEGER NOT NULL,
+                passed INTEGER NOT NULL,
+                PRIMARY KEY (user_id, test_name)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS stats_users (
+                user_id INTEGER PRIMARY KEY,
+                fio TEXT,
+                city TEXT,
+                tests_attempted INTEGER NOT NULL DEFAULT 0,
+                tests_passed INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS stats_users_passed ON stats_users (tests_passed, user_id);
+            CREATE TABLE IF NOT EXISTS stats_cities (
+                city TEXT PRIMARY KEY,
+                registered INTEGER NOT NULL DEFAULT 0,
+                attempted INTEGER NOT NULL DEFAULT 0,
+                passed INTEGER NOT NULL DEFAULT 0
+            );
+            """
+        )
+        return fresh
+
+    def _add_to_city(self, city: str, registered: int, attempted: int, passed: int):
+        self._conn.execute(
+            """INSERT INTO stats_cities (city, registered, attempted, passed) VALUES (?, ?, ?, ?)
+               ON CONFLICT (city) DO UPDATE SET
+                   registered = registered + excluded.registered,
+                   attempted = attempted + excluded.attempted,
+                   passed = passed + excluded.passed""",
+            (city, registered, attempted, passed)
+        )
+
+    def on_user(self, user_id: int, fio: str, city: str):
+        row = self._conn.execute(
+            "SELECT city, tests_attempted > 0, tests_passed > 0 FROM stats_users WHERE user_id = ?", (user_id,)
+        ).fetchone()
+        old_city, attempted, passed = tuple(row) if row else (None, 0, 0)
+        self._conn.execute(
+            """INSERT INTO stats_users (user_id, fio, city) VALUES (?, ?, ?)
+               ON CONFLICT (user_id) DO UPDATE SET fio = excluded.fio, city = excluded.city""",
+            (user_id, fio, city)
+        )
+        if old_city == city:
+            return
+        # Смена города переносит пользователя со всеми его отметками
+        if old_city is not None:
+            self._add_to_city(old_city, -1, -attempted, -passed)
+        self._add_to_city(city, 1, attempted, passed)
+
+    def on_result(self, user_id: int, test_name: str, score: int, max_score: int):
+        passed = int(is_passing(score, max_score))
+        row = self._conn.execute(
+            "SELECT passed FROM stats_user_tests WHERE user_id = ? AND test_name = ?", (user_id, test_name)
+        ).fetchone()
+        first_attempt = int(row is None)
+        first_pass = int(passed and (row is None or not row[0]))
+        self._conn.execute(
+            """INSERT INTO stats_user_tests (user_id, test_name, attempts, best_score, passed) VALUES (?, ?, 1, ?, ?)
+               ON CONFLICT (user_id, test_name) DO UPDATE SET
+                   attempts = attempts + 1,
+                   best_score = MAX(best_score, excluded.best_score),
+                   passed = MAX(passed, excluded.passed)""",
+            (user_id, test_name, score, passed)
+        )
+        self._conn.execute(
+            """INSERT INTO stats_tests (test_name, attempts, passed_attempts, users, passed_users) VALUES (?, 1, ?, ?, ?)
+               ON CONFLICT (test_name) DO UPDATE SET
+                   attempts = attempts + 1,
+                   passed_attempts = passed_attempts + excluded.passed_attempts,
+                   users = users + excluded.users,
+                   passed_users = passed_users + excluded.passed_users""",
+            (test_name, passed, first_attempt, first_pass)
+        )
+        if not (first_attempt or first_pass):
+            return
+
+        user = self._conn.execute(
+            "SELECT city, tests_attempted, tests_passed FROM stats_users WHERE user_id = ?", (user_id,)
+        ).fetchone()
+        city, tests_attempted, tests_passed = tuple(user) if user else (None, 0, 0)
+        self._conn.execute(
+            """INSERT INTO stats_users (user_id, tests_attempted, tests_passed) VALUES (?, ?, ?)
+               ON CONFLICT (user_id) DO UPDATE SET
+                   tests_attempted = tests_attempted + excluded.tests_attempted,
+                   tests_passed = tests_passed + excluded.tests_passed""",
+            (user_id, first_attempt, first_pass)
+        )
+        # Город учитывает пользователя один раз — по первому тесту
+        newly_attempted = int(first_attempt and tests_attempted == 0)
+        newly_passed = int(first_pass and tests_passed == 0)
+        if city is not None and (newly_attempted or newly_passed):
+            self._add_to_city(city, 0, newly_attempted, newly_passed)
+
+    def test_stats(self) -> list:
+        rows = self._conn.execute(
+            "SELECT test_name, attempts, passed_attempts, users, passed_users FROM stats_tests ORDER BY test_name"
+        ).fetchall()
+        return [dict(zip(("test_name", "attempts", "passed_attempts", "users", "passed_users"), row)) for row in rows]
+
+    def city_stats(self) -> list:
+        rows = self._conn.execute(
+            "SELECT city, registered, attempted, passed FROM stats_cities WHERE registered > 0 ORDER BY registered DESC, city"
+        ).fetchall()
+        return [dict(zip(("city", "registered", "attempted", "passed"), row)) for row in rows]
+
+    def users_without_pass(self, limit: int) -> tuple:
+        total = self._conn.execute(
+            "SELECT COUNT(*) FROM stats_users WHERE tests_passed = 0 AND city IS NOT NULL"
+        ).fetchone()[0]
+        rows = self._conn.execute(
+            """SELECT user_id, fio, city, tests_attempted FROM stats_users
+               WHERE tests_passed = 0 AND city IS NOT NULL ORDER BY user_id LIMIT ?""",
+            (limit,)
+        ).fetchall()
+        return total, [dict(zip(("user_id", "fio", "city", "tests_attempted"), row)) for row in rows]
+
+    def user_ids(self, after_user_id: int, limit: int, without_pass: bool = False) -> list:
+        """Зарегистрированные user_id по возрастанию, начиная после after_user_id"""
+        condition = "tests_passed = 0 AND " if without_pass else ""
+        rows = self._conn.execute(
+            f"""SELECT user_id FROM stats_users
+                WHERE {condition}user_id > ? AND city IS NOT NULL ORDER BY user_id LIMIT ?""",
+            (after_user_id, limit)
+        ).fetchall()
+        return [row[0] for row in rows]
+
+class Storage(ABC):
+    """Интерфейс хранилища пользователей и результатов тестов"""
+
+    # Удалённое хранилище вызывается через пул потоков
+    is_remote = False
+
+    @abstractmethod
+    def register_user(self, user_id: int, username: str, fio: str, city: str):
+        """Сохраняет анкету пользователя"""
+
+    @abstractmethod
+    def get_user(self, user_id: int):
+        """Анкета пользователя (dict с колонками USER_COLUMNS) или None"""
+
+    @abstractmethod
+    def registered_user_ids(self) -> set:
+        """Все зарегистрированные user_id"""
+
+    @abstractmethod
+    def record_result(self, user_id: int, fio: str, test_name: str, score: int, max_score: int, answers: str):
+        """Сохраняет результат прохождения теста; answers — строка ответов (см. ANSWER ENCODING)"""
+
+    @abstractmethod
+    def query_results(self, user_id: int = None, test_name: str = None) -> list:
+        """Результаты (dict с колонками RESULT_COLUMNS), отфильтрованные по пользователю и тесту"""
+
+    # --- Аналитика (из агрегатов ResultStats, без чтения всех результатов) ---
+
+    @abstractmethod
+    def test_stats(self) -> list:
+        """По каждому тесту: попытки, сданные попытки, пользователи, сдавшие пользователи"""
+
+    @abstractmethod
+    def city_stats(self) -> list:
+        """По каждому городу: зарегистрировано, проходили тесты, сдали хотя бы один"""
+
+    @abstractmethod
+    def users_without_pass(self, limit: int) -> tuple:
+        """(сколько всего, первые limit) зарегистрированных без единой сданной попытки"""
+
+    @abstractmethod
+    def answer_patterns(self) -> list:
+        """Различные строки ответов с числом попыток: [(тест, ответы, сколько), ...]"""
+
+    @abstractmethod
+    def recipient_ids(self, after_user_id: int, limit: int, without_pass: bool = False) -> list:
+        """Следующие limit зарегистрированных user_id больше after_user_id, по возрастанию"""
+
+class SQLiteStorage(Storage):
+    """Хранилище в локальной SQLite с очередью выгрузки в Google Таблицы"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=FULL")
+        with self._conn:
+            self._conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS users (
+                    user_id INTEGER PRIMARY KEY,
+                    username TEXT NOT NULL,
+                    fio TEXT NOT NULL,
+                    city TEXT NOT NULL,
+                    register_date TEXT NOT NULL,
+                    last_activity TEXT NOT NULL,
+                    export_status INTEGER NOT NULL DEFAULT 0,
+                    export_inflight INTEGER NOT NULL DEFAULT 0
+                );
+                CREATE TABLE IF NOT EXISTS results (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER NOT NULL,
+                    fio TEXT NOT NULL,
+                    test_name TEXT NOT NULL,
+                    score INTEGER NOT NULL,
+                    max_score INTEGER NOT NULL,
+                    pass_date TEXT NOT NULL,
+                    answers TEXT NOT NULL,
+                    export_status INTEGER NOT NULL DEFAULT 0,
+                    export_inflight INTEGER NOT NULL DEFAULT 0
+                );
+                CREATE INDEX IF NOT EXISTS results_user_id ON results (user_id);
+                -- Покрывает и отбор по тесту, и группировку ответов (answer_patterns)
+                DROP INDEX IF EXISTS results_test_name;
+                CREATE INDEX IF NOT EXISTS results_test_answers ON results (test_name, answers);
+                CREATE INDEX IF NOT EXISTS users_export ON users (export_status);
+                CREATE INDEX IF NOT EXISTS results_export ON results (export_status, id);
+                """
+            )
+            self._stats = ResultStats(self._conn)
+            if self._stats.create_schema():
+                self._rebuild_stats()
+
+    def _rebuild_stats(self):
+        """Один раз наполняет агрегаты по уже накопленным данным"""
+        users = self._conn.execute("SELECT user_id, fio, city FROM users").fetchall()
+        results = self._conn.execute("SELECT user_id, test_name, score, max_score FROM results ORDER BY id").fetchall()
+        if users or results:
+            logger.info(f"📊 Пересчитываем агрегаты: {len(users)} пользователей, {len(results)} результатов")
+        for row in users:
+            self._stats.on_user(*row)
+        for row in results:
+            self._stats.on_result(*row)
+
+    def register_user(self, user_id, username, fio, city):
+        now = now_str()
+        with self._lock, self._conn:
+            # Повторная регистрация обновляет анкету, но не дублирует строку в таблице
+            self._conn.execute(
+                """INSERT INTO users (user_id, username, fio, city, register_date, last_activity)
+                   VALUES (?, ?, ?, ?, ?, ?)
+                   ON CONFLICT (user_id) DO UPDATE SET
+                       username = excluded.username, fio = excluded.fio,
+                       city = excluded.city, last_activity = excluded.last_activity""",
+                (user_id, username, fio, city, now, now)
+            )
+            self._stats.on_user(user_id, fio, city)
+
+    def get_user(self, user_id):
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT {', '.join(USER_COLUMNS)} FROM users WHERE user_id = ?", (user_id,)
+            ).fetchone()
+        return dict(row) if row else None
+
+    def registered_user_ids(self):
+        with self._lock:
+            return {row[0] for row in self._conn.execute("SELECT user_id FROM users")}
+
+    def record_result(self, user_id, fio, test_name, score, max_score, answers):
+        with self._lock, self._conn:
+            self._conn.execute(
+                """INSERT INTO results (user_id, fio, test_name, score, max_score, pass_date, answers)
+                   VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                (user_id, fio, test_name, score, max_score, now_str(), answers)
+            )
+            self._stats.on_result(user_id, test_name, score, max_score)
+
+    def query_results(self, user_id=None, test_name=None):
+        conditions, params = [], []
+        if user_id is not None:
+            conditions.append("user_id = ?")
+            params.append(user_id)
+        if test_name is not None:
+            conditions.append("test_name = ?")
+            params.append(test_name)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        # Выгрузка может читать сотни тысяч строк: своё соединение вместо
+        # общего под замком, иначе на всё это время встанут вызовы из цикла
+        # событий. WAL пускает читателя параллельно с записью.
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        try:
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA query_only=ON")
+            rows = conn.execute(
+                f"SELECT {', '.join(RESULT_COLUMNS)} FROM results {where} ORDER BY id", params
+            ).fetchall()
+        finally:
+            conn.close()
+        return [dict(row) for row in rows]
+
+    def test_stats(self):
+        with self._lock:
+            return self._stats.test_stats()
+
+    def city_stats(self):
+        with self._lock:
+            return self._stats.city_stats()
+
+    def users_without_pass(self, limit):
+        with self._lock:
+            return self._stats.users_without_pass(limit)
+
+    def recipient_ids(self, after_user_id, limit, without_pass=False):
+        with self._lock:
+            return self._stats.user_ids(after_user_id, limit, without_pass)
+
+    def answer_patterns(self):
+        # Группировка в SQLite: в Python приходят только различные строки ответов
+        with self._lock:
+            return [tuple(row) for row in self._conn.execute(
+                "SELECT test_name, answers, COUNT(*) FROM results GROUP BY test_name, answers"
+            )]
+
+    # --- Выгрузка в Google Таблицы ---
+
+    _EXPORT_TABLES = {
+        "users": ("user_id", USER_COLUMNS),
+        "results": ("id", RESULT_COLUMNS),
+    }
+
+    def pending_export(self, table: str, limit: int = -1) -> list:
+        """Невыгруженные строки: [(id, строка для листа, inflight), ...]"""
+        key, columns = self._EXPORT_TABLES[table]
+        with self._lock:
+            rows = self._conn.execute(
+                f"""SELECT {key}, {', '.join(columns)}, export_inflight FROM {table}
+                    WHERE export_status = ? ORDER BY {key} LIMIT ?""",
+                (EXPORT_PENDING, limit)
+            ).fetchall()
+        return [(row[0], [str(value) for value in tuple(row)[1:-1]], bool(row[-1])) for row in rows]
+
+    def set_export_inflight(self, table: str, ids: list, inflight: bool):
+        """Отмечает строки, исход отправки которых может быть неизвестен"""
+        key, _ = self._EXPORT_TABLES[table]
+        with self._lock, self._conn:
+            self._conn.executemany(
+                f"UPDATE {table} SET export_inflight = ? WHERE {key} = ?",
+                [(int(inflight), record_id) for record_id in ids]
+            )
+
+    def export_backlog(self, table: str) -> int:
+        """Сколько строк ждут выгрузки"""
+        with self._lock:
+            return self._conn.execute(
+                f"SELECT COUNT(*) FROM {table} WHERE export_status = ?", (EXPORT_PENDING,)
+            ).fetchone()[0]
+
+    def mark_exported(self, table: str, ids: list, status: int = EXPORT_DONE):
+        """Фиксирует итог выгрузки строк"""
+        key, _ = self._EXPORT_TABLES[table]
+        with self._lock, self._conn:
+            self._conn.executemany(
+                f"UPDATE {table} SET export_status = ?, export_inflight = 0 WHERE {key} = ?",
+                [(status, record_id) for record_id in ids]
+            )
+
+class SheetsStorage(Storage):
+    """Хранилище прямо в Google Таблицах (каждый вызов — запрос к API)"""
+
+    is_remote = True
+
+    def __init__(self, get_users_sheet, get_tests_sheet):
+        self.get_users_sheet = get_users_sheet
+        self.get_tests_sheet = get_tests_sheet
+        # Агрегаты держим в SQLite в памяти: листы читаются один раз,
+        # при первом запросе аналитики, дальше агрегаты ведут записи
+        self._stats_lock = threading.Lock()
+        self._stats = None
+        self._stats_conn = None
+
+    @staticmethod
+    def _require(sheet, name: str):
+        if not sheet:
+            raise RuntimeError(f"{name} не инициализирован")
+        return sheet
+
+    def register_user(self, user_id, username, fio, city):
+        sheet = self._require(self.get_users_sheet(), "USERS_SHEET")
+        now = now_str()
+        sheet.append_row([str(user_id), username, fio, city, now, now])
+        self._update_stats(ResultStats.on_user, user_id, fio, city)
+
+    def get_user(self, user_id):
+        sheet = self._require(self.get_users_sheet(), "USERS_SHEET")
+        cell = sheet.find(str(user_id), in_column=1)
+        if cell is None:
+            return None
+        return dict(zip(USER_COLUMNS, sheet.row_values(cell.row)))
+
+    def registered_user_ids(self):
+        sheet = self._require(self.get_users_sheet(), "USERS_SHEET")
+        column = sheet.col_values(1)[1:]  # первая строка — заголовок
+        return {int(value) for value in (v.strip() for v in column) if value.isdigit()}
+
+    def record_result(self, user_id, fio, test_name, score, max_score, answers):
+        sheet = self._require(self.get_tests_sheet(), "TESTS_SHEET")
+        sheet.append_row([str(user_id), fio, test_name, str(score), str(max_score), now_str(), answers])
+        self._update_stats(ResultStats.on_result, user_id, test_name, score, max_score)
+
+    def query_results(self, user_id=None, test_name=None):
+        sheet = self._require(self.get_tests_sheet(), "TESTS_SHEET")
+        results = []
+        for row in sheet.get_all_values()[1:]:
+            record = dict(zip(RESULT_COLUMNS, row))
+            if user_id is not None and record.get("user_id") != str(user_id):
+                continue
+            if test_name is not None and record.get("test_name") != test_name:
+                continue
+            results.append(record)
+        return results
+
+    def _update_stats(self, method, *args):
+        with self._stats_lock:
+            if self._stats is not None:
+                with self._stats_conn:
+                    method(self._stats, *args)
+
+    def _load_stats(self) -> ResultStats:
+        """Агрегаты; при первом обращении строятся по содержимому листов"""
+        if self._stats is None:
+            users = self._require(self.get_users_sheet(), "USERS_SHEET").get_all_values()[1:]
+            results = self._require(self.get_tests_sheet(), "TESTS_SHEET").get_all_values()[1:]
+            conn = sqlite3.connect(":memory:", check_same_thread=False)
+            stats = ResultStats(conn)
+            with conn:
+                stats.create_schema()
+                for row in users:
+                    record = dict(zip(USER_COLUMNS, row))
+                    if record.get("user_id", "").strip().isdigit():
+                        stats.on_user(int(record["user_id"]), record.get("fio", ""), record.get("city", ""))
+                for row in results:
+                    record = dict(zip(RESULT_COLUMNS, row))
+                    try:
+                        stats.on_result(int(record["user_id"]), record["test_name"],
+                                        int(record["score"]), int(record["max_score"]))
+                    except (KeyError, ValueError):
+                        continue
+            self._stats, self._stats_conn = stats, conn
+        return self._stats
+
+    def test_stats(self):
+        with self._stats_lock:
+            return self._load_stats().test_stats()
+
+    def city_stats(self):
+        with self._stats_lock:
+            return self._load_stats().city_stats()
+
+    def users_without_pass(self, limit):
+        with self._stats_lock:
+            return self._load_stats().users_without_pass(limit)
+
+    def recipient_ids(self, after_user_id, limit, without_pass=False):
+        with self._stats_lock:
+            return self._load_stats().user_ids(after_user_id, limit, without_pass)
+
+    def answer_patterns(self):
+        sheet = self._require(self.get_tests_sheet(), "TESTS_SHEET")
+        test_column = RESULT_COLUMNS.index("test_name")
+        answers_column = RESULT_COLUMNS.index("answers")
+        patterns = defaultdict(int)
+        for row in sheet.get_all_values()[1:]:
+            if len(row) > answers_column:
+                patterns[row[test_column], row[answers_column]] += 1
+        return [(test_name, answers, count) for (test_name, answers), count in patterns.items()]
+
+def create_storage() -> Storage:
+    """Создаёт хранилище по STORAGE_BACKEND"""
+    if STORAGE_BACKEND == "sheets":
+        logger.info("🗄️ Хранилище: Google Таблицы")
+        return SheetsStorage(lambda: USERS_SHEET, lambda: TESTS_SHEET)
+    logger.info(f"🗄️ Хранилище: SQLite ({DB_PATH})")
+    return SQLiteStorage(DB_PATH)
+
+STORAGE = create_storage()
+
+async def storage_call(func, *args, **kwargs):
+    """Вызов хранилища: удалённое — через пул потоков, локальное — напрямую"""
+    if STORAGE.is_remote:
+        return await run_sheets_call(func, *args, **kwargs)
+    return func(*args, **kwargs)
+
+# ==============================
+# 📤 SHEETS EXPORT
+# ==============================
+# Новые строки SQLite уходят в листы одним append_rows: пачка на
+# SHEETS_BATCH_SIZE строк или раз в SHEETS_FLUSH_INTERVAL секунд
+SHEETS_BATCH_SIZE = int(os.getenv("SHEETS_BATCH_SIZE", 100))
+SHEETS_FLUSH_INTERVAL = float(os.getenv("SHEETS_FLUSH_INTERVAL", 2))
+SHEETS_BACKOFF_BASE = 1.0
+SHEETS_BACKOFF_MAX = 64.0
+SHEETS_SHUTDOWN_TIMEOUT = float(os.getenv("SHEETS_SHUTDOWN_TIMEOUT", 30))
+# Замок выгрузки продлевается перед каждой пачкой: срок покрывает самую
+# длинную паузу между пачками (бэкофф плюс таймаут вызова)
+SHEETS_EXPORT_LEASE_TTL = 120
+
+def is_retryable_sheets_error(error: Exception) -> bool:
+    """Квота (429), ошибки сервера Google и сетевые сбои стоит повторить"""
+    status = sheets_error_status(error)
+    if status is not None:
+        return status == 429 or status >= 500
+    return isinstance(error, (asyncio.TimeoutError, ConnectionError, OSError))
+
+def is_write_outcome_unknown(error: Exception) -> bool:
+    """Запись могла дойти до таблицы, хотя ответа мы не получили"""
+    status = sheets_error_status(error)
+    return status is None or status >= 500
+
+class SheetsExporter:
+    """Периодическая выгрузка новых строк SQLite в лист Google Таблицы"""
+
+    def __init__(self, storage: SQLiteStorage, table: str, get_sheet, key_columns: tuple,
+                 batch_size: int = SHEETS_BATCH_SIZE, flush_interval: float = SHEETS_FLUSH_INTERVAL):
+        self.storage = storage
+        self.table = table
+        self.get_sheet = get_sheet
+        # Колонки, по которым строка узнаётся в листе при повторной выгрузке
+        self.key_columns = key_columns
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._wakeup = None
+        self._lock = None
+        self._task = None
+        self._closing = False
+        # Строки, добавленные этой репликой после последней выгрузки
+        self._queued = 0
+
+    def start(self):
+        """Запускает фоновую выгрузку в текущем event loop"""
+        self._wakeup = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._closing = False
+        self._task = asyncio.create_task(self._run())
+
+    def wakeup(self):
+        """Просит выгрузить накопленное, не дожидаясь таймера"""
+        if self._wakeup:
+            self._wakeup.set()
+
+    def note_added(self, count: int = 1):
+        """Учитывает новые строки: набралась пачка — выгружаем, не дожидаясь таймера"""
+        self._queued += count
+        if self._queued >= self.batch_size:
+            self._queued = 0
+            self.wakeup()
+
+    async def close(self):
+        """Дописывает остаток при остановке бота"""
+        if not self._task:
+            return
+        self._closing = True
+        self._wakeup.set()
+        try:
+            await asyncio.wait_for(asyncio.shield(self._task), timeout=SHEETS_SHUTDOWN_TIMEOUT)
+        except asyncio.TimeoutError:
+            self._task.cancel()
+            logger.warning(f"⚠️ Выгрузка '{self.table}' не завершена, строки будут выгружены после перезапуска")
+        self._task = None
+
+    async def _run(self):
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            self._queued = 0
+            await self.flush()
+        await self.flush()
+
+    def _key(self, row: list) -> tuple:
+        return tuple(str(row[i]) if i < len(row) else "" for i in self.key_columns)
+
+    async def _drop_already_written(self, sheet, batch: list) -> list:
+        """Отсеивает строки, которые уже попали в лист при прошлой попытке"""
+        values = await run_sheets_call(sheet.get_all_values)
+        written = {self._key(row) for row in values[1:]}
+        duplicates = [record_id for record_id, row, _ in batch if self._key(row) in written]
+        if duplicates:
+            self.storage.mark_exported(self.table, duplicates)
+            logger.info(f"♻️ Выгрузка '{self.table}': {len(duplicates)} строк уже были в листе")
+        return [record for record in batch if record[0] not in duplicates]
+
+    async def flush(self) -> bool:
+        """Выгружает новые строки пачками, при 429 — с экспоненциальной паузой"""
+        async with self._lock:
+            # Выгрузку одной базы ведёт одна реплика
+            lease = f"export:{os.path.abspath(self.storage.path)}:{self.table}"
+            try:
+                return await self._flush(lease)
+            finally:
+                release_lease(lease)
+
+    async def _flush(self, lease: str) -> bool:
+        delay = SHEETS_BACKOFF_BASE
+        while True:
+            if not try_lease(lease, SHEETS_EXPORT_LEASE_TTL):
+                return False
+            sheet = self.get_sheet()
+            if not sheet:
+                return False
+
+            batch = self.storage.pending_export(self.table, self.batch_size)
+            if not batch:
+                return True
+
+            ids = [record_id for record_id, _, _ in batch]
+            sent = False
+            try:
+                # Исход прошлой отправки неизвестен — сверяемся с листом
+                if any(inflight for _, _, inflight in batch):
+                    batch = await self._drop_already_written(sheet, batch)
+                    ids = [record_id for record_id, _, _ in batch]
+                    if not batch:
+                        continue
+                self.storage.set_export_inflight(self.table, ids, True)
+                sent = True
+                await run_sheets_call(sheet.append_rows, [row for _, row, _ in batch])
+            except Exception as e:
+                if sent and not is_write_outcome_unknown(e):
+                    self.storage.set_export_inflight(self.table, ids, False)
+                if not is_retryable_sheets_error(e):
+                    self.storage.mark_exported(self.table, ids, EXPORT_REJECTED)
+                    logger.error(f"❌ Выгрузка '{self.table}': пачка из {len(ids)} строк отклонена: {e}")
+                    continue
+                logger.warning(f"⚠️ Выгрузка '{self.table}': ошибка записи ({e}), повтор через {delay:.0f} с")
+                await asyncio.sleep(delay + random.uniform(0, delay / 2))
+                delay = min(delay * 2, SHEETS_BACKOFF_MAX)
+                continue
+
+            self.storage.mark_exported(self.table, ids)
+            logger.info(f"✅ Выгрузка '{self.table}': записано строк — {len(ids)}")
+            delay = SHEETS_BACKOFF_BASE
+
+# Пользователь узнаётся по user_id, результат — по user_id, тесту и времени
+SHEETS_EXPORTERS = []
+if isinstance(STORAGE, SQLiteStorage):
+    SHEETS_EXPORTERS = [
+        SheetsExporter(STORAGE, "users", lambda: USERS_SHEET, key_columns=(0,)),
+        SheetsExporter(STORAGE, "results", lambda: TESTS_SHEET, key_columns=(0, 2, 5)),
+    ]
+
+def notify_export(table: str):
+    """Сообщает выгрузке таблицы о новой строке"""
+    for exporter in SHEETS_EXPORTERS:
+        if exporter.table == table:
+            exporter.note_added()
+
+EXPORT_BACKLOG = Gauge(
+    "bot_sheets_export_backlog", "Строки, ждущие выгрузки в Google Таблицы", ("table",),
+    collect=lambda: {(e.table,): e.storage.export_backlog(e.table) for e in SHEETS_EXPORTERS}
+)
+
+# Бесконечные фоновые циклы, которые останавливаются вместе с ботом
+BACKGROUND_TASKS = []
+
+async def post_init(application: Application):
+    """Запускает фоновые задачи после инициализации бота"""
+    for exporter in SHEETS_EXPORTERS:
+        exporter.start()
+    BACKGROUND_TASKS.append(asyncio.create_task(USER_STATE.sweep_loop()))
+    BACKGROUND_TASKS.append(asyncio.create_task(watch_catalog()))
+    BROADCASTER.start(application.bot)
+    if not (USERS_SHEET and TESTS_SHEET):
+        BACKGROUND_TASKS.append(asyncio.create_task(connect_google_sheets()))
+
+async def post_shutdown(application: Application):
+    """Останавливает фоновые задачи и дописывает выгрузку в таблицу"""
+    for task in BACKGROUND_TASKS:
+        task.cancel()
+    BACKGROUND_TASKS.clear()
+    await BROADCASTER.close()
+    await asyncio.gather(*(exporter.close() for exporter in SHEETS_EXPORTERS))
+
+# ==============================
+# 📣 BROADCASTS
+# ==============================
+# Рассылки администратора всем партнёрам (/broadcast) или только тем, кто
+# ещё не сдал ни одного теста (/remind). Получатели читаются из хранилища
+# пачками по user_id, пачка отправляется параллельно с низким приоритетом
+# через OutboundRateLimiter, после каждой пачки прогресс сохраняется —
+# после перезапуска рассылка продолжается со следующей пачки.
+BROADCAST_DB_PATH = os.getenv("BROADCAST_DB_PATH", "bot_broadcasts.db")
+BROADCAST_CHUNK_SIZE = int(os.getenv("BROADCAST_CHUNK_SIZE", 100))
+BROADCAST_POLL_INTERVAL = float(os.getenv("BROADCAST_POLL_INTERVAL", 30))
+BROADCAST_SHUTDOWN_TIMEOUT = 10
+# Рассылки выполняет одна реплика; замок продлевается после каждой пачки
+BROADCAST_LEASE = "broadcast"
+BROADCAST_LEASE_TTL = 120
+
+AUDIENCE_ALL = "all"
+AUDIENCE_NOPASS = "nopass"
+
+BROADCAST_MESSAGES = Counter(
+    "bot_broadcast_messages_total", "Сообщения рассылок по исходу доставки", labels=("outcome",)
+)
+
+class BroadcastJobs:
+    """Задания рассылок и их прогресс в SQLite"""
+
+    COLUMNS = ("id", "audience", "text", "run_at", "status", "cursor", "sent", "blocked", "failed", "elapsed")
+
+    def __init__(self, path: str):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        with self._conn:
+            self._conn.execute(
+                """CREATE TABLE IF NOT EXISTS broadcasts (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    audience TEXT NOT NULL,
+                    text TEXT NOT NULL,
+                    run_at REAL NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'scheduled',
+                    cursor INTEGER NOT NULL DEFAULT 0,
+                    sent INTEGER NOT NULL DEFAULT 0,
+                    blocked INTEGER NOT NULL DEFAULT 0,
+                    failed INTEGER NOT NULL DEFAULT 0,
+                    elapsed REAL NOT NULL DEFAULT 0
+                )"""
+            )
+
+    def _rows(self, query: str, params: tuple = ()) -> list:
+        rows = self._conn.execute(f"SELECT {', '.join(self.COLUMNS)} FROM broadcasts {query}", params).fetchall()
+        return [dict(zip(self.COLUMNS, row)) for row in rows]
+
+    def create(self, audience: str, text: str, run_at: float) -> int:
+        with self._conn:
+            return self._conn.execute(
+                "INSERT INTO broadcasts (audience, text, run_at) VALUES (?, ?, ?)", (audience, text, run_at)
+            ).lastrowid
+
+    def next_due(self):
+        """Прерванная рассылка или самая ранняя из наступивших; None, если таких нет"""
+        rows = self._rows(
+            """WHERE status = 'running' OR (status = 'scheduled' AND run_at <= ?)
+               ORDER BY status = 'running' DESC, run_at LIMIT 1""",
+            (time.time(),)
+        )
+        return rows[0] if rows else None
+
+    def next_run_at(self):
+        row = self._conn.execute("SELECT MIN(run_at) FROM broadcasts WHERE status = 'scheduled'").fetchone()
+        return row[0]
+
+    def checkpoint(self, job: dict):
+        with self._conn:
+            self._conn.execute(
+                """UPDATE broadcasts SET status = ?, cursor = ?, sent = ?, blocked = ?, failed = ?, elapsed = ?
+                   WHERE id = ?""",
+                (job["status"], job["cursor"], job["sent"], job["blocked"], job["failed"], job["elapsed"], job["id"])
+            )
+
+    def cancel(self, job_id: int) -> bool:
+        with self._conn:
+            return self._conn.execute(
+                "UPDATE broadcasts SET status = 'cancelled' WHERE id = ? AND status IN ('scheduled', 'running')",
+                (job_id,)
+            ).rowcount > 0
+
+    def is_cancelled(self, job_id: int) -> bool:
+        row = self._conn.execute("SELECT status FROM broadcasts WHERE id = ?", (job_id,)).fetchone()
+        return row is None or row[0] == "cancelled"
+
+    def recent(self, limit: int = 5) -> list:
+        return self._rows("ORDER BY id DESC LIMIT ?", (limit,))
+
+class Broadcaster:
+    """Фоновое выполнение рассылок по одной за раз"""
+
+    def __init__(self, jobs: BroadcastJobs, chunk_size: int = BROADCAST_CHUNK_SIZE):
+        self.jobs = jobs
+        self.chunk_size = chunk_size
+        self._bot = None
+        self._wakeup = None
+        self._task = None
+        self._closing = False
+
+    def start(self, bot):
+        self._bot = bot
+        self._wakeup = asyncio.Event()
+        self._closing = False
+        self._task = asyncio.create_task(self._run())
+
+    def wakeup(self):
+        if self._wakeup:
+            self._wakeup.set()
+
+    async def close(self):
+        """Даёт дослать текущую пачку, чтобы после перезапуска не повторять её"""
+        if not self._task:
+            return
+        self._closing = True
+        self._wakeup.set()
+        try:
+            await asyncio.wait_for(asyncio.shield(self._task), timeout=BROADCAST_SHUTDOWN_TIMEOUT)
+        except asyncio.TimeoutError:
+            self._task.cancel()
+            logger.warning("⚠️ Пачка рассылки не дослана, после перезапуска она уйдёт повторно")
+        self._task = None
+
+    async def _run(self):
+        while not self._closing:
+            job = self.jobs.next_due() if try_lease(BROADCAST_LEASE, BROADCAST_LEASE_TTL) else None
+            if job:
+                try:
+                    await self._execute(job)
+                except Exception as e:
+                    logger.error(f"❌ Рассылка #{job['id']} прервана: {e}")
+                    await asyncio.sleep(BROADCAST_POLL_INTERVAL)
+                finally:
+                    release_lease(BROADCAST_LEASE)
+                continue
+            release_lease(BROADCAST_LEASE)
+            next_run_at = self.jobs.next_run_at()
+            timeout = BROADCAST_POLL_INTERVAL
+            if next_run_at is not None:
+                timeout = min(timeout, max(0.0, next_run_at - time.time()))
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    async def _send(self, user_id: int, text: str) -> str:
+        try:
+            await self._bot.send_message(chat_id=user_id, text=text, rate_limit_args=PRIORITY_LOW)
+            return "sent"
+        except Forbidden:
+            # Пользователь заблокировал бота
+            return "blocked"
+        except TelegramError as e:
+            logger.warning(f"⚠️ Рассылка: не доставлено {user_id}: {e}")
+            return "failed"
+
+    async def _execute(self, job: dict):
+        resumed = job["status"] == "running"
+        if not resumed:
+            job["status"] = "running"
+            self.jobs.checkpoint(job)
+            await self._report(f"📣 Рассылка #{job['id']} начата")
+        else:
+            logger.info(f"📣 Рассылка #{job['id']} продолжается с user_id > {job['cursor']}")
+
+        without_pass = job["audience"] == AUDIENCE_NOPASS
+        while not self._closing:
+            if not try_lease(BROADCAST_LEASE, BROADCAST_LEASE_TTL):
+                logger.warning(f"⚠️ Рассылку #{job['id']} продолжит другая реплика")
+                return
+            if self.jobs.is_cancelled(job["id"]):
+                await self._report(f"🛑 Рассылка #{job['id']} отменена: доставлено {job['sent']}")
+                return
+            recipients = await storage_call(STORAGE.recipient_ids, job["cursor"], self.chunk_size, without_pass)
+            if not recipients:
+                break
+            started = time.perf_counter()
+            outcomes = await asyncio.gather(*(self._send(user_id, job["text"]) for user_id in recipients))
+            for outcome in outcomes:
+                job[outcome] += 1
+                BROADCAST_MESSAGES.inc(outcome)
+            job["cursor"] = recipients[-1]
+            job["elapsed"] += time.perf_counter() - started
+            self.jobs.checkpoint(job)
+        else:
+            # Бот останавливается: прогресс сохранён, продолжим после перезапуска
+            return
+
+        job["status"] = "done"
+        self.jobs.checkpoint(job)
+        total = job["sent"] + job["blocked"] + job["failed"]
+        rate = total / job["elapsed"] if job["elapsed"] else 0.0
+        await self._report(
+            f"✅ Рассылка #{job['id']} завершена\n"
+            f"Доставлено: {job['sent']}, заблокировали бота: {job['blocked']}, ошибки: {job['failed']}\n"
+            f"Время отправки: {job['elapsed']:.1f} с, {rate:.1f} сообщ./с"
+        )
+
+    async def _report(self, text: str):
+        logger.info(text.replace("\n", "; "))
+        try:
+            await self._bot.send_message(chat_id=ADMIN_ID, text=text, rate_limit_args=PRIORITY_HIGH)
+        except TelegramError as e:
+            logger.warning(f"⚠️ Не удалось отправить отчёт о рассылке: {e}")
+
+BROADCASTER = Broadcaster(BroadcastJobs(BROADCAST_DB_PATH))
+
+def parse_broadcast_args(message_text: str) -> tuple:
+    """Разбирает '/команда [ЧЧ:ММ] текст' в (время запуска, текст)
+
+    Текст берётся из сообщения как есть: context.args склеил бы его
+    через пробел и потерял переносы строк.
+    """
+    run_at = time.time()
+    # Отрезаем команду, затем необязательное время — остальное не трогаем
+    parts = (message_text or "").split(None, 1)
+    text = parts[1] if len(parts) > 1 else ""
+    head = text.split(None, 1)
+    if head:
+        try:
+            at = datetime.strptime(head[0], "%H:%M")
+        except ValueError:
+            pass
+        else:
+            now = datetime.now()
+            scheduled = now.replace(hour=at.hour, minute=at.minute, second=0, microsecond=0)
+            if scheduled <= now:
+                scheduled += timedelta(days=1)
+            run_at = scheduled.timestamp()
+            text = head[1] if len(head) > 1 else ""
+    return run_at, text
+
+def describe_broadcast(job: dict) -> str:
+    when = datetime.fromtimestamp(job["run_at"]).strftime("%d.%m %H:%M")
+    audience = "все" if job["audience"] == AUDIENCE_ALL else "без сданного теста"
+    return (
+        f"#{job['id']} [{job['status']}] {when}, получатели: {audience}, "
+        f"доставлено {job['sent']}, заблокировали {job['blocked']}, ошибки {job['failed']}"
+    )
+
+async def schedule_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE, audience: str):
+    run_at, text = parse_broadcast_args(update.message.text)
+    if not text:
+        recent = BROADCASTER.jobs.recent()
+        lines = [
+            "Использование: /broadcast [ЧЧ:ММ] текст — всем партнёрам",
+            "/remind [ЧЧ:ММ] текст — тем, кто не сдал ни одного теста",
+            "/cancel_broadcast N — отменить рассылку",
+        ]
+        if recent:
+            lines.append("\nПоследние рассылки:")
+            lines.extend(describe_broadcast(job) for job in recent)
+        await update.message.reply_text("\n".join(lines))
+        return
+    job_id = BROADCASTER.jobs.create(audience, text, run_at)
+    BROADCASTER.wakeup()
+    when = datetime.fromtimestamp(run_at).strftime("%d.%m %H:%M")
+    await update.message.reply_text(f"📣 Рассылка #{job_id} запланирована на {when}")
+
+async def admin_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await schedule_broadcast(update, context, AUDIENCE_ALL)
+
+async def admin_remind(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await schedule_broadcast(update, context, AUDIENCE_NOPASS)
+
+async def admin_cancel_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if len(context.args) != 1 or not context.args[0].isdigit():
+        await update.message.reply_text("Использование: /cancel_broadcast N")
+        return
+    if BROADCASTER.jobs.cancel(int(context.args[0])):
+        await update.message.reply_text(f"🛑 Рассылка #{context.args[0]} отменена")
     else:
-        logger.warning("⚠️ Google Таблицы не инициализированы - данные будут сохраняться только локально")
-    
-    # Создаем application с обработкой ошибок
-    application = Application.builder().token(TOKEN).build()
+        await update.message.reply_text(f"Рассылка #{context.args[0]} не найдена или уже завершена")
+
+# ==============================
+# 🌐 HTTP SERVER (HEALTH & WEBHOOK)
+# ==============================
+# Один aiohttp-сервер в том же event loop, что и бот: отвечает на
+# проверки здоровья Render и, в режиме webhook, принимает обновления
+# Telegram. В режиме webhook обязателен WEBHOOK_SECRET: без него любой,
+# кто достучится до порта, подделает обновление от имени администратора.
+# Локально режим webhook проверяется без Telegram — достаточно не задавать
+# WEBHOOK_URL и отправить сохранённый Update с секретом в заголовке:
+#   curl -X POST localhost:10000/telegram -H 'Content-Type: application/json' \
+#        -H "X-Telegram-Bot-Api-Secret-Token: $WEBHOOK_SECRET" -d @update.json
+BOT_MODE = os.getenv("BOT_MODE", "polling")  # polling | webhook
+PORT = int(os.environ.get('PORT', 10000))
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # публичный адрес сервиса, например https://bot.onrender.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+
+async def home(request: web.Request) -> web.Response:
+    return web.Response(text="OK")
+
+async def health(request: web.Request) -> web.Response:
+    return web.Response(text="Bot is alive")
+
+UPDATE_QUEUE_DEPTH = Gauge("bot_update_queue", "Обновления Telegram, ждущие обработки")
+
+def create_web_app(application: Application) -> web.Application:
+    """Собирает aiohttp-приложение с health-эндпоинтами и приёмом webhook"""
+
+    async def telegram_webhook(request: web.Request) -> web.Response:
+        token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not WEBHOOK_SECRET or not secrets.compare_digest(token.encode(), WEBHOOK_SECRET.encode()):
+            return web.Response(status=403)
+        try:
+            data = await request.json()
+            update = Update.de_json(data, application.bot)
+        except ValueError:
+            return web.Response(status=400, text="Invalid JSON")
+        except (TypeError, KeyError, AttributeError):
+            # Корректный JSON, но не Update (например, без update_id)
+            return web.Response(status=400, text="Invalid update")
+        if update is None:
+            return web.Response(status=400, text="Invalid update")
+        await application.update_queue.put(update)
+        return web.Response(text="OK")
+
+    async def metrics(request: web.Request) -> web.Response:
+        UPDATE_QUEUE_DEPTH.set(application.update_queue.qsize())
+        return web.Response(text=render_metrics(), content_type="text/plain", charset="utf-8")
+
+    web_app = web.Application()
+    web_app.router.add_get('/', home)
+    web_app.router.add_get('/health', health)
+    web_app.router.add_get('/metrics', metrics)
+    if BOT_MODE == "webhook":
+        web_app.router.add_post(WEBHOOK_PATH, telegram_webhook)
+    return web_app
+
+# ==============================
+# 🚦 OUTBOUND RATE LIMITER
+# ==============================
+# Все исходящие сообщения проходят через общий и по-чатовый token bucket
+# (лимиты Telegram: ~30 сообщений/с на бота, ~1/с в одном чате). Кто ждёт
+# общего лимита, выпускается по приоритету: результаты тестов — раньше
+# обычных ответов, рассылки — позже. На 429 запрос повторяется через
+# retry_after, который прислал Telegram.
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", 30))
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", 1))
+TELEGRAM_CHAT_BURST = float(os.getenv("TELEGRAM_CHAT_BURST", 3))
+TELEGRAM_MAX_RETRIES = int(os.getenv("TELEGRAM_MAX_RETRIES", 3))
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+# Служебные методы, которые не считаются сообщениями
+UNLIMITED_ENDPOINTS = {
+    "getMe", "getUpdates", "setWebhook", "deleteWebhook", "getWebhookInfo",
+    "answerCallbackQuery", "logOut", "close",
+}
+
+RATE_LIMIT_WAITERS = Gauge("bot_telegram_send_waiters", "Исходящие запросы, ждущие общего лимита")
+RATE_LIMIT_RETRIES = Counter("bot_telegram_retry_after_total", "Ответы 429 от Telegram")
+
+class TokenBucket:
+    """Маркеры копятся со скоростью rate, но не больше burst"""
+
+    __slots__ = ("rate", "burst", "tokens", "updated", "blocked_until")
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        # Пауза по retry_after от Telegram
+        self.blocked_until = 0.0
+
+    def take(self) -> float:
+        """Берёт маркер и возвращает 0 или сообщает, сколько секунд подождать"""
+        now = time.monotonic()
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def give_back(self):
+        self.tokens = min(self.burst, self.tokens + 1)
+
+    def is_idle(self) -> bool:
+        now = time.monotonic()
+        return now >= self.blocked_until and self.tokens + (now - self.updated) * self.rate >= self.burst
+
+class OutboundRateLimiter(BaseRateLimiter):
+    """Ограничитель исходящих запросов Bot API с приоритетами и повтором после 429"""
+
+    MAX_CHAT_BUCKETS = 10000
+
+    def __init__(self, global_rate: float = TELEGRAM_GLOBAL_RATE, chat_rate: float = TELEGRAM_CHAT_RATE,
+                 chat_burst: float = TELEGRAM_CHAT_BURST, max_retries: int = TELEGRAM_MAX_RETRIES):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats = {}
+        # Очередь ожидающих общего лимита: (приоритет, порядковый номер, future)
+        self._waiters = []
+        self._sequence = itertools.count()
+        self._dispatcher = None
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        if self._dispatcher:
+            self._dispatcher.cancel()
+            self._dispatcher = None
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= self.MAX_CHAT_BUCKETS:
+                # Полный бакет ничем не отличается от нового — такие забываем
+                for idle_chat in [chat for chat, b in self._chats.items() if b.is_idle()]:
+                    del self._chats[idle_chat]
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    async def _acquire_chat(self, chat_id):
+        bucket = self._chat_bucket(chat_id)
+        while True:
+            wait = bucket.take()
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+    async def _acquire_global(self, priority: int):
+        if not self._waiters and not self._global.take():
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._sequence), future))
+        RATE_LIMIT_WAITERS.set(len(self._waiters))
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        await future
+
+    async def _dispatch(self):
+        """Выдаёт маркеры общего лимита ожидающим в порядке приоритета"""
+        while self._waiters:
+            wait = self._global.take()
+            if wait:
+                await asyncio.sleep(wait)
+                continue
+            _, _, future = heapq.heappop(self._waiters)
+            RATE_LIMIT_WAITERS.set(len(self._waiters))
+            if future.done():
+                self._global.give_back()
+            else:
+                future.set_result(None)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        if endpoint in UNLIMITED_ENDPOINTS:
+            return await callback(*args, **kwargs)
+
+        priority = PRIORITY_NORMAL if rate_limit_args is None else rate_limit_args
+        chat_id = data.get("chat_id")
+        for attempt in range(self.max_retries + 1):
+            if chat_id is not None:
+                await self._acquire_chat(chat_id)
+            await self._acquire_global(priority)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                RATE_LIMIT_RETRIES.inc()
+                if attempt == self.max_retries:
+                    raise
+                retry_after = e.retry_after
+                seconds = retry_after.total_seconds() if isinstance(retry_after, timedelta) else float(retry_after)
+                # Пауза касается чата, а если чата нет — всего бота
+                bucket = self._chat_bucket(chat_id) if chat_id is not None else self._global
+                bucket.blocked_until = max(bucket.blocked_until, time.monotonic() + seconds)
+                logger.warning(f"⚠️ Telegram 429 на {endpoint}: повтор через {seconds:.0f} с")
+
+# ==============================
+# 🔀 UPDATE PROCESSING
+# ==============================
+# Обновления разных пользователей обрабатываются параллельно (не больше
+# MAX_CONCURRENT_UPDATES одновременно), обновления одного пользователя —
+# строго по очереди: двойное нажатие не гоняет два обработчика над одной сессией.
+# Слот параллельности берётся только после очереди пользователя (и замка
+# user:<id> в общем режиме): ожидающие обновления не занимают слоты, поэтому
+# пользователь с пачкой нажатий или замок упавшей реплики не останавливают
+# остальных.
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", 256))
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Последовательная обработка в пределах пользователя, параллельная — между пользователями"""
+
+    def __init__(self, max_concurrent_updates: int):
+        # PTB держит свой семафор на всё время do_process_update, включая
+        # ожидание очереди пользователя, — его не ограничиваем, слоты считаем сами
+        super().__init__(sys.maxsize)
+        self._slots = asyncio.Semaphore(max_concurrent_updates)
+        # user_id -> [asyncio.Lock, сколько обновлений ждут или держат замок]
+        self._locks = {}
+
+    async def _run(self, coroutine):
+        async with self._slots:
+            await coroutine
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        user = update.effective_user if isinstance(update, Update) else None
+        if user is None:
+            await self._run(coroutine)
+            return
+
+        entry = self._locks.get(user.id)
+        if entry is None:
+            entry = self._locks[user.id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                if STATE_STORE is None or not STATE_STORE.shared:
+                    await self._run(coroutine)
+                    return
+                # Другие реплики могут обрабатывать этого же пользователя
+                lock_key = f"user:{user.id}"
+                await acquire_lease(lock_key, USER_LOCK_TTL)
+                # Долгий обработчик (медленная таблица) не должен потерять замок
+                renewal = asyncio.create_task(keep_lease(lock_key, USER_LOCK_TTL))
+                try:
+                    await self._run(coroutine)
+                finally:
+                    renewal.cancel()
+                    release_lease(lock_key)
+        finally:
+            entry[1] -= 1
+            # Замок больше никому не нужен — не копим их для всех пользователей
+            if entry[1] == 0:
+                del self._locks[user.id]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+# ==============================
+# 🚀 MAIN FUNCTION
+# ==============================
+def build_application(request: BaseRequest = None) -> Application:
+    """Создаёт Application со всеми обработчиками; request подменяет HTTP-клиент Bot API"""
+    builder = (
+        Application.builder()
+        .token(TOKEN)
+        .concurrent_updates(PerUserUpdateProcessor(MAX_CONCURRENT_UPDATES))
+        .rate_limiter(OutboundRateLimiter())
+    )
+    if request is not None:
+        builder = builder.request(request)
+    if BOT_MODE == "webhook":
+        # Обновления приходят через HTTP-сервер, Updater не нужен
+        builder = builder.updater(None)
+    elif request is not None:
+        builder = builder.get_updates_request(request)
+    application = builder.build()
+
+    # Все правила диалога уже объявлены — собираем таблицу переходов
+    CONVERSATION.compile()
 
     # Обработчики
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("help", help_command))
     application.add_handler(CommandHandler("about", about))
+    admin_only = filters.User(user_id=ADMIN_ID)
+    application.add_handler(CommandHandler("stats", admin_stats, filters=admin_only))
+    application.add_handler(CommandHandler("cities", admin_cities, filters=admin_only))
+    application.add_handler(CommandHandler("nopass", admin_nopass, filters=admin_only))
+    application.add_handler(CommandHandler("items", admin_items, filters=admin_only))
+    application.add_handler(CommandHandler("answers", admin_answers, filters=admin_only))
+    application.add_handler(CommandHandler("broadcast", admin_broadcast, filters=admin_only))
+    application.add_handler(CommandHandler("remind", admin_remind, filters=admin_only))
+    application.add_handler(CommandHandler("cancel_broadcast", admin_cancel_broadcast, filters=admin_only))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
     application.add_handler(CallbackQueryHandler(button))
 
     # Обработчик ошибок
     async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        BOT_ERRORS.inc(type(context.error).__name__)
         logger.error(f"❌ Ошибка: {context.error}")
         
     application.add_error_handler(error_handler)
+    return application
 
-    logger.info("✅ Бот готов к работе!")
-    
-    # Запускаем с обработкой конфликтов
+STARTUP_SECONDS = Gauge("bot_startup_seconds", "Время запуска по этапам", ("phase",))
+
+async def run_bot(started: float):
+    """Запускает бота и HTTP-сервер в одном event loop до сигнала остановки
+
+    started — момент начала запуска (perf_counter) для отчёта о его длительности.
+    """
+    application = build_application()
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            pass
+
+    runner = web.AppRunner(create_web_app(application))
+    await runner.setup()
+
+    await application.initialize()
+    await post_init(application)
+    await application.start()
     try:
-        application.run_polling(
-            allowed_updates=Update.ALL_TYPES,
-            drop_pending_updates=True  # Важно: игнорируем старые updates
-        )
-    except Exception as e:
-        logger.error(f"❌ Критическая ошибка: {e}")
-        # Ждем и перезапускаем
-        asyncio.sleep(5)
-        main()
+        if BOT_MODE == "webhook":
+            if WEBHOOK_URL:
+                webhook_url = WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH
+                if not SHARED_STATE:
+                    await application.bot.set_webhook(
+                        url=webhook_url,
+                        secret_token=WEBHOOK_SECRET,
+                        allowed_updates=Update.ALL_TYPES,
+                        drop_pending_updates=True  # Важно: игнорируем старые updates
+                    )
+                    logger.info(f"✅ Webhook установлен: {webhook_url}")
+                # Реплик несколько: перезапуск одной не должен выбрасывать
+                # очередь обновлений всего бота. Webhook ставим, только если он
+                # указывает не туда; новый WEBHOOK_SECRET при том же адресе
+                # нужно установить вручную (setWebhook).
+                elif (await application.bot.get_webhook_info()).url != webhook_url:
+                    await application.bot.set_webhook(
+                        url=webhook_url,
+                        secret_token=WEBHOOK_SECRET,
+                        allowed_updates=Update.ALL_TYPES,
+                    )
+                    logger.info(f"✅ Webhook установлен: {webhook_url}")
+                else:
+                    logger.info(f"✅ Webhook уже указывает на {webhook_url}")
+            else:
+                logger.warning(f"⚠️ WEBHOOK_URL не задан — обновления принимаются только POST-запросами на {WEBHOOK_PATH}")
+        else:
+            await application.updater.start_polling(
+                allowed_updates=Update.ALL_TYPES,
+                drop_pending_updates=True  # Важно: игнорируем старые updates
+            )
+
+        await web.TCPSite(runner, '0.0.0.0', PORT).start()
+        startup = time.perf_counter() - started
+        STARTUP_SECONDS.set(round(startup, 3), "ready")
+        logger.info(f"✅ Бот готов к работе за {startup:.2f} с! Режим: {BOT_MODE}, порт {PORT}")
+        await stop_event.wait()
+    finally:
+        logger.info("🛑 Остановка бота...")
+        await runner.cleanup()
+        if application.updater and application.updater.running:
+            await application.updater.stop()
+        if application.running:
+            await application.stop()
+        await post_shutdown(application)
+        await application.shutdown()
+
+RESTART_DELAY = 5
+
+def shared_setup_errors() -> list:
+    """Почему общий режим (SHARED_STATE) не сможет работать с текущими настройками"""
+    if not SHARED_STATE:
+        return []
+    errors = []
+    if SHARED_STATE not in ("sqlite", "redis"):
+        errors.append(f"неизвестный SHARED_STATE={SHARED_STATE!r}, ожидается sqlite или redis")
+    # Агрегаты SheetsStorage живут в памяти каждой реплики и разошлись бы
+    if STORAGE_BACKEND != "sqlite":
+        errors.append("в общем режиме нужен STORAGE_BACKEND=sqlite")
+    if not SHARED_DATA_DIR:
+        errors.append("не задан SHARED_DATA_DIR — общий том для баз пользователей, результатов и рассылок")
+        return errors
+    paths = {"DB_PATH": DB_PATH, "BROADCAST_DB_PATH": BROADCAST_DB_PATH}
+    if SHARED_STATE == "sqlite":
+        paths["SESSION_DB_PATH"] = SESSION_DB_PATH
+    shared_dir = os.path.realpath(SHARED_DATA_DIR)
+    for name, path in paths.items():
+        if not path or os.path.commonpath([shared_dir, os.path.realpath(path)]) != shared_dir:
+            errors.append(f"{name}={path!r} вне общего тома SHARED_DATA_DIR={SHARED_DATA_DIR!r}")
+    return errors
+
+def main():
+    if not TOKEN:
+        logger.error("❌ BOT_TOKEN не задан!")
+        exit(1)
+    if BOT_MODE == "webhook" and not WEBHOOK_SECRET:
+        logger.error("❌ В режиме webhook нужен WEBHOOK_SECRET (A-Z, a-z, 0-9, _ и -)")
+        exit(1)
+    errors = shared_setup_errors()
+    if errors:
+        for error in errors:
+            logger.error(f"❌ Общий режим реплик: {error}")
+        exit(1)
+
+    imported = time.perf_counter() - STARTUP_STARTED
+    STARTUP_SECONDS.set(round(imported, 3), "import")
+    logger.info(f"🚀 Запуск Бота обучения партнёров ПВЗ (модуль загружен за {imported:.2f} с)...")
+
+    # Индекс зарегистрированных пользователей и его фоновое обновление.
+    # Из Google Таблиц индекс загрузится после подключения к ним.
+    if not STORAGE.is_remote:
+        load_registered_users()
+    refresh_thread = threading.Thread(target=refresh_registered_users_loop)
+    refresh_thread.daemon = True
+    refresh_thread.start()
+
+    # Перезапускаем бота после сбоя в цикле, а не рекурсией: стек и фоновые
+    # потоки не копятся, а штатная остановка (SIGTERM) завершает процесс
+    started = STARTUP_STARTED
+    while True:
+        try:
+            asyncio.run(run_bot(started))
+            break
+        except Exception as e:
+            logger.error(f"❌ Критическая ошибка: {e}")
+            time.sleep(RESTART_DELAY)
+            started = time.perf_counter()
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()